@@ -1,110 +1,166 @@
-import boto3
 import json
-import os
-import base64
-import datatier
-from configparser import ConfigParser
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import runtime
+import predictions
+import tracelog
+
+# most S3 objects fetched (or model inputs stored) at once; the
+# threads are kept for warm invocations
+max_fetch_workers = 16
+pool = ThreadPoolExecutor(max_workers=max_fetch_workers)
+
+def fetch_image(s3_client, s3_bucket, s3_key):
+    response = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
+    return response['Body'].read()
 
 def lambda_handler(event, context):
+    trace = tracelog.start('compute', context)
+    records = []
     try:
-        print("**STARTING**")
-        
-        #
-        # setup AWS based on config file:
-        #
-        config_file = 'config.ini'
-        os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-        
-        configur = ConfigParser()
-        configur.read(config_file)
-        
+
         #
-        # configurefor permissions
+        # config, clients and RDS connections are set up once per
+        # execution environment by runtime and reused when warm:
         #
-        s3_profile = 'blake' 
-        boto3.setup_default_session(profile_name=s3_profile)
+        s3_profile = 'blake'
+
+        # get bucket and key of every object that triggered this call;
+        # S3 URL-encodes keys in event records
+        for record in event['Records']:
+            records.append({
+                'bucket': record['s3']['bucket']['name'],
+                'bucket_key': urllib.parse.unquote_plus(record['s3']['object']['key']),
+            })
+
+        trace.event("records received", records=len(records))
+        if len(records) == 1:
+            trace.bind(bucket_key=records[0]['bucket_key'])
+
+        s3_client = runtime.client('s3', s3_profile)
 
         #
-        # configure for RDS access
+        # fetch every object concurrently; a failed download only
+        # fails its own record. Concurrent S3 calls are timed as one
+        # stage here rather than in the pool threads (see tracelog.py)
         #
-        rds_endpoint = configur.get('rds', 'endpoint')
-        rds_portnum = int(configur.get('rds', 'port_number'))
-        rds_username = configur.get('rds', 'user_name')
-        rds_pwd = configur.get('rds', 'user_pwd')
-        rds_dbname = configur.get('rds', 'db_name')
-
-        
-        # get bucket and key of what triggered this compute call
-        s3_bucket = event['Records'][0]['s3']['bucket']['name']
-        s3_key = event['Records'][0]['s3']['object']['key']
-
-        s3_client = boto3.client('s3')
-        
-        try:
-            # encode the image into json format 
-            response = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
-            image_data = response['Body'].read()
-            encoded_image = base64.b64encode(image_data).decode('utf-8')
-            input_data= {"image": encoded_image}
-            input_json = json.dumps(input_data)
-            print(input_json)
-            
-        except Exception as e:
-            print(f"Error downloading image from S3: {e}")
-            return {
-                'statusCode': 500,
-                'body': json.dumps({'error': 'Internal Server Error'})
-            }
-        
-        # send the image to the sagemaker endpoint
-        
-        sage_maker_endpoint_name = 'artifact-v6'
-        sagemaker_runtime = boto3.client('sagemaker-runtime')
-        try:
-            response = sagemaker_runtime.invoke_endpoint(
-                EndpointName=sage_maker_endpoint_name,
-                ContentType= "application/json",
-                Body=input_json
-            )
-
-            # Process the prediction result as needed
-            prediction_result = json.loads(response['Body'].read().decode())
-            actual_prob= 100*(1-prediction_result["probability_real"])
-            print("Probability of ai image:", actual_prob)
-
-        except Exception as e:
-            print(f"Error invoking SageMaker endpoint: {e}")
-            return {
-                'statusCode': 500,
-                'body': json.dumps({'error': 'Internal Server Error'})
-            }
-            
-        # put the probability into database and update status
-        dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-
-    
-        sql1 = "SELECT image_id FROM imageMetadata WHERE bucket_key = %s";
-    
-        row = datatier.retrieve_one_row(dbConn, sql1, [s3_key])
-        image_id= row[0]
-        print("image id",image_id)
-    
-        sql2 = "UPDATE imagePredictions SET precentage_ai = %s, status = %s WHERE image_id = %s";
-    
-        # update: status is complete and percentage is accurate
-    
-        datatier.perform_action(dbConn, sql2, [actual_prob, "complete",image_id])
-        
+        def fetch(record):
+            try:
+                return fetch_image(s3_client, record['bucket'], record['bucket_key']), None
+            except Exception as e:
+                return None, f"Error downloading image from S3: {e}"
+
+        with tracelog.stage("s3.get"):
+            fetched = list(pool.map(fetch, records))
+
+        images = []
+        for record, (image_data, error) in zip(records, fetched):
+            if error:
+                trace.error(error, bucket_key=record['bucket_key'])
+                record['error'] = error
+            else:
+                images.append((record, image_data))
+
+        # send all the images to the sagemaker endpoint, in as few
+        # calls as its request size limit allows; it also hands back
+        # each image's 3x32x32 model input, which is stored so that
+        # re-scoring never has to decode the original again
+
+        sagemaker_runtime = runtime.client('sagemaker-runtime', s3_profile)
+        stores = []
+        if images:
+            try:
+                scored, model_inputs = predictions.invoke_endpoint_batch(
+                    sagemaker_runtime, [image_data for _, image_data in images],
+                    return_inputs=True)
+
+                def store(item):
+                    record, model_input = item
+                    try:
+                        predictions.store_model_input(
+                            s3_client, record['bucket'], record['bucket_key'], model_input)
+                    except Exception as e:
+                        # only costs a decode when the image is re-scored
+                        trace.error(f"Error storing model input: {e}",
+                                    bucket_key=record['bucket_key'])
+
+                # stored while the results are written to the database
+                stores_started = time.perf_counter()
+                stores = [pool.submit(store, (record, model_input))
+                          for (record, _), model_input in zip(images, model_inputs)
+                          if model_input is not None]
+
+                for (record, _), entry in zip(images, scored):
+                    if entry is None:
+                        # its call failed, so the job is left pending
+                        record['error'] = "Error invoking SageMaker endpoint"
+                        continue
+                    actual_prob, error = entry
+                    if error:
+                        # the image itself is bad, so the job is finished
+                        record['status'] = 'error'
+                        record['error'] = error
+                        trace.error(error, bucket_key=record['bucket_key'])
+                    else:
+                        record['status'] = 'complete'
+                        record['precentage_ai'] = actual_prob
+
+            except Exception as e:
+                # leave these jobs pending, they can be retried
+                trace.error(f"Error invoking SageMaker endpoint: {e}", image_count=len(images))
+                for record, _ in images:
+                    record['error'] = f"Error invoking SageMaker endpoint: {e}"
+
+        # put the probabilities into database and update statuses
+        done = [record for record in records if 'status' in record]
+
+        if done:
+            with runtime.db() as dbConn:
+
+                # one query resolves every image_id
+                image_ids = predictions.resolve_image_ids(
+                    dbConn, [record['bucket_key'] for record in done])
+
+                results = []
+                for record in done:
+                    image_id = image_ids.get(record['bucket_key'])
+                    if image_id is None:
+                        record['error'] = "no image with this bucket key"
+                        del record['status']
+                        continue
+                    record['image_id'] = image_id
+                    if len(records) == 1:
+                        trace.bind(image_id=image_id)
+                    results.append((image_id, record.get('precentage_ai', 0), record['status']))
+
+                # and one UPDATE writes every result
+                predictions.write_predictions(dbConn, results)
+
+        for future in stores:
+            future.result()
+        if stores:
+            # from the first store starting to the last one finishing
+            trace.add_stage("s3.put_model_input", stores_started)
+
+        failed = [record for record in records if 'status' not in record]
+        status_code = 200 if not failed else 500
+        # always logged, so every image can be followed through compute
+        trace.finish(status_code, records=len(records),
+                     complete=len(records) - len(failed), failed=len(failed),
+                     bucket_keys=[record['bucket_key'] for record in records],
+                     image_ids=[record.get('image_id') for record in records])
+
         return {
-        'statusCode': 200,
-        'body': actual_prob
+        'statusCode': status_code,
+        'body': json.dumps({'records': records})
         }
-    
+
     except Exception as err:
-        print("**ERROR**")
-        print(str(err))
-        
+        trace.error(str(err), error_type=type(err).__name__)
+        trace.finish(400, bucket_keys=[record['bucket_key'] for record in records])
+
         return {
         'statusCode': 400,
         'body': "compute_complete"
-        }
\ No newline at end of file
+        }
@@ -1,176 +1,512 @@
 import json
-import boto3
-import os
+import time
+import hashlib
 import datatier
 import base64
+import runtime
+import tracelog
+import resultcache
+import statuswatch
 
-from configparser import ConfigParser
+#
+# what a response carries besides the metadata and prediction:
+#   metadata: nothing else
+#   url: a presigned GET URL for the original image
+#   inline: the original image, base64 encoded (the original behaviour)
+#
+response_modes = ('metadata', 'url', 'inline')
+
+# how long a presigned image URL stays valid, in seconds
+image_url_expiration = 900
+
+# most image ids answered by one batch call
+max_batch_ids = 1000
+
+# listing page sizes
+default_page_size = 50
+max_page_size = 500
+
+job_statuses = ('pending', 'in_progress', 'complete', 'error')
+
+# longest a wait-mode request is held open, in seconds; API Gateway
+# gives up on an integration after 29
+max_wait_seconds = 25
+
+def get_param(event, name):
+  #
+  # a parameter given directly in the event, in the query string or
+  # in a JSON request body
+  #
+  if name in event:
+    return event[name]
+  query = event.get("queryStringParameters") or {}
+  if name in query:
+    return query[name]
+  try:
+    body = json.loads(event.get("body") or "{}")
+  except ValueError:
+    return None
+  return body.get(name) if isinstance(body, dict) else None
+
+def parse_image_ids(value):
+  #
+  # a list, or a comma-separated string as sent in a query string
+  #
+  if isinstance(value, str):
+    value = [part for part in value.split(",") if part.strip()]
+  if not isinstance(value, list):
+    raise ValueError("image_ids must be a list")
+  return value
+
+def as_image_id(value):
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return None
+
+# every job column retrieve answers with, metadata and prediction
+job_columns = """
+  m.image_id, m.time_uploaded, m.image_size, m.file_name, m.bucket_key,
+  p.precentage_ai, p.model_version, p.status"""
+
+def job_results(row):
+  #
+  # a row of job_columns as (bucketkey, results); status is None if
+  # the image has no prediction row
+  #
+  results= {
+    "time_uploaded": row[1].isoformat() if row[1] else None,
+    "image_size":row[2],
+    "file_name":row[3],
+    "precentage_ai":float(row[5]) if row[5] is not None else None,
+    "model_version":row[6],
+    "status":row[7]
+  }
+  return row[4], results
+
+def select_jobs(dbConn, image_ids):
+  #
+  # the metadata and prediction of many images in one round trip;
+  # returns {image_id: row}, leaving out ids that don't exist
+  #
+  if not image_ids:
+    return {}
+
+  sql = "SELECT" + job_columns + """
+  FROM imageMetadata m
+  LEFT JOIN imagePredictions p ON p.image_id = m.image_id
+  WHERE m.image_id IN (""" + ",".join(["%s"] * len(image_ids)) + """)
+  ORDER BY p.prediction_id;"""
+
+  with tracelog.stage("sql.select_jobs"):
+    rows = datatier.retrieve_all_rows(dbConn, sql, list(image_ids))
+
+  # should an image have several predictions, the newest one wins
+  return {row[0]: row for row in rows}
+
+def list_jobs(dbConn, status, after, limit):
+  #
+  # the most recent jobs first, optionally only those with the given
+  # status, as a keyset-paginated page: only ids below 'after'. Both
+  # variants walk an index in order, (status, image_id) or the primary
+  # key, so a page costs the same however deep it is.
+  #
+  params = []
+  if status is None:
+    sql = "SELECT" + job_columns + """
+    FROM imageMetadata m
+    LEFT JOIN imagePredictions p ON p.image_id = m.image_id"""
+    if after is not None:
+      sql += " WHERE m.image_id < %s"
+      params.append(after)
+    sql += " ORDER BY m.image_id DESC LIMIT %s;"
+  else:
+    sql = "SELECT" + job_columns + """
+    FROM imagePredictions p
+    JOIN imageMetadata m ON m.image_id = p.image_id
+    WHERE p.status = %s"""
+    params.append(status)
+    if after is not None:
+      sql += " AND p.image_id < %s"
+      params.append(after)
+    sql += " ORDER BY p.image_id DESC LIMIT %s;"
+  params.append(limit)
+
+  with tracelog.stage("sql.list_jobs"):
+    return datatier.retrieve_all_rows(dbConn, sql, params)
+
+def cache_results(result_cache, jobs, image_ids):
+  #
+  # only complete results are final, anything else must read through;
+  # a result of an older model is about to be re-scored, so it isn't
+  # final either
+  #
+  result_cache.set_many({
+    image_id: {"bucket_key": jobs[image_id][0], "results": jobs[image_id][1]}
+    for image_id in image_ids
+    if image_id in jobs and jobs[image_id][1]["status"] == 'complete'
+      and jobs[image_id][1]["model_version"] == result_cache.version
+  })
+
+def read_jobs(result_cache, image_ids):
+  #
+  # finished jobs come from the cache, only the rest are queried;
+  # returns ({image_id: (bucketkey, results)}, number of cache hits)
+  #
+  jobs = {image_id: (cached["bucket_key"], cached["results"])
+          for image_id, cached in result_cache.get_many(list(image_ids)).items()}
+  cache_hits = len(jobs)
+
+  missing = set(image_ids) - set(jobs)
+  if missing:
+    with runtime.db() as dbConn:
+      rows = select_jobs(dbConn, missing)
+    for image_id, row in rows.items():
+      jobs[image_id] = job_results(row)
+    cache_results(result_cache, jobs, missing)
+
+  return jobs, cache_hits
+
+def check_statuses(image_ids):
+  #
+  # the database status check statuswatch shares between all waiters
+  #
+  sql = "SELECT image_id, status FROM imagePredictions WHERE image_id IN (" + \
+    ",".join(["%s"] * len(image_ids)) + ");"
+
+  with runtime.db() as dbConn:
+    rows = datatier.retrieve_all_rows(dbConn, sql, list(image_ids))
+  return dict(rows)
+
+def parse_wait(event):
+  #
+  # seconds a request may be held open for its jobs to finish
+  #
+  wait = get_param(event, "wait")
+  if wait in (None, ""):
+    return 0
+  try:
+    wait = float(wait)
+  except (TypeError, ValueError):
+    raise Exception("wait must be a number of seconds")
+  return min(max(wait, 0), max_wait_seconds)
+
+def wait_for_jobs(result_cache, jobs, wait):
+  #
+  # long poll: holds the request until every unfinished job in jobs
+  # is complete or error, or wait seconds pass, then re-reads those
+  # jobs into jobs. Returns how many jobs were waited on.
+  #
+  unfinished = [image_id for image_id, (_, results) in jobs.items()
+                if results["status"] in ('pending', 'in_progress')]
+  if not wait or not unfinished:
+    return 0
+
+  shared_check = result_cache.get_statuses if result_cache.shared is not None else None
+  with tracelog.stage("wait"):
+    statuswatch.watcher(check_statuses, shared_check).wait(unfinished, wait)
+
+  jobs.update(read_jobs(result_cache, unfinished)[0])
+  return len(unfinished)
+
+def presigned_image_url(s3, bucketname, bucketkey):
+  return s3.generate_presigned_url(
+    'get_object',
+    Params={'Bucket': bucketname, 'Key': bucketkey},
+    ExpiresIn=image_url_expiration
+  )
+
+def batch_retrieve(event, image_ids, bucketname, s3_client):
+  #
+  # answers many image ids with one query, in request order; ids that
+  # don't exist are marked instead of failing the whole call. Only
+  # the metadata and url modes are offered, inline images would make
+  # the response arbitrarily large.
+  #
+  trace = tracelog.current()
+
+  if not image_ids:
+    trace.finish(400, error="empty image_ids")
+    return {
+      'statusCode': 400,
+      'body': json.dumps("image_ids must be a non-empty list")
+    }
+  if len(image_ids) > max_batch_ids:
+    trace.finish(400, error="too many image_ids")
+    return {
+      'statusCode': 400,
+      'body': json.dumps("at most " + str(max_batch_ids) + " image_ids per call")
+    }
+
+  mode = get_param(event, "mode") or 'metadata'
+  if mode not in ('metadata', 'url'):
+    trace.finish(400, error="unknown mode")
+    return {
+      'statusCode': 400,
+      'body': json.dumps("batch mode must be one of: metadata, url")
+    }
+
+  ids = [as_image_id(image_id) for image_id in image_ids]
+  wanted = set(image_id for image_id in ids if image_id is not None)
+
+  result_cache = resultcache.cache()
+  jobs, cache_hits = read_jobs(result_cache, wanted)
+  waited = wait_for_jobs(result_cache, jobs, parse_wait(event))
+
+  results = []
+  for requested, image_id in zip(image_ids, ids):
+    if image_id not in jobs:
+      results.append({'image_id': requested, 'found': False, 'error': "no such image"})
+      continue
+
+    bucketkey, job = jobs[image_id]
+    job = dict(job)
+    job['image_id'] = image_id
+    job['found'] = True
+    if job['status'] is None:
+      job['error'] = "no prediction"
+    elif mode == 'url':
+      job['image_url'] = presigned_image_url(s3_client, bucketname, bucketkey)
+    results.append(job)
+
+  found = sum(1 for job in results if job['found'])
+  trace.finish(200, requested=len(image_ids), found=found, mode=mode, waited=waited,
+               cache_hits=cache_hits, cache_stats=result_cache.stats())
+
+  return {
+    'statusCode': 200,
+    'body': json.dumps({'results': results})
+  }
+
+def list_recent(event):
+  #
+  # one page of recent jobs; pass the returned next_after back as
+  # 'after' for the next page, it is null on the last one
+  #
+  trace = tracelog.current()
+
+  status = get_param(event, "status") or None
+  if status is not None and status not in job_statuses:
+    trace.finish(400, error="unknown status")
+    return {
+      'statusCode': 400,
+      'body': json.dumps("status must be one of: " + ", ".join(job_statuses))
+    }
+
+  after = get_param(event, "after")
+  limit = get_param(event, "limit") or default_page_size
+  try:
+    after = int(after) if after not in (None, "") else None
+    limit = int(limit)
+  except (TypeError, ValueError):
+    trace.finish(400, error="bad paging parameters")
+    return {
+      'statusCode': 400,
+      'body': json.dumps("after and limit must be integers")
+    }
+  if not 1 <= limit <= max_page_size:
+    trace.finish(400, error="bad limit")
+    return {
+      'statusCode': 400,
+      'body': json.dumps("limit must be between 1 and " + str(max_page_size))
+    }
+
+  with runtime.db() as dbConn:
+    rows = list_jobs(dbConn, status, after, limit)
+
+  jobs = []
+  for row in rows:
+    _, job = job_results(row)
+    job['image_id'] = row[0]
+    jobs.append(job)
+
+  next_after = jobs[-1]['image_id'] if len(jobs) == limit else None
+
+  trace.finish(200, status=status, jobs=len(jobs))
+
+  return {
+    'statusCode': 200,
+    'body': json.dumps({'jobs': jobs, 'next_after': next_after})
+  }
+
+def get_header(event, name):
+  #
+  # HTTP header names are case-insensitive
+  #
+  for key, value in (event.get("headers") or {}).items():
+    if key.lower() == name.lower():
+      return value
+  return ""
+
+def response_mode(event, status):
+  #
+  # finished jobs default to the inline image, as before; polls of an
+  # unfinished job only get the metadata unless they ask for more
+  #
+  mode = get_param(event, "mode")
+  if mode:
+    return mode
+  return 'inline' if status == 'complete' else 'metadata'
+
+def make_etag(image_id, results, mode):
+  #
+  # the image behind a bucket key never changes, so the job state
+  # and the mode determine the response. In url mode the ETag also
+  # rolls over every half expiration period, so a 304 never leaves a
+  # client holding a URL with less than half its lifetime left.
+  #
+  state = [image_id, mode, results]
+  if mode == 'url':
+    state.append(int(time.time() // (image_url_expiration // 2)))
+  digest = hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode())
+  return '"' + digest.hexdigest()[:32] + '"'
 
 def lambda_handler(event, context):
+  trace = tracelog.start('retrieve', context)
   try:
-    print("**STARTING**")
-    print("**lambda: retrieve**")
 
     #
-    # setup AWS based on config file:
+    # config, S3 and RDS access are set up once per execution
+    # environment by runtime and reused by warm invocations:
     #
-    config_file = 'config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
+    configur = runtime.config()
     
-    #
-    # configure for S3 access:
-    #
     s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
-    
     bucketname = configur.get('s3', 'bucket_name')
     
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
     #
-    # configure for RDS access
+    # many image ids at once: a batch retrieve
     #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
-    
+    image_ids = get_param(event, "image_ids")
+    if image_ids is not None:
+      s3 = runtime.client('s3', s3_profile)
+      return batch_retrieve(event, parse_image_ids(image_ids), bucketname, s3)
+
     #
     # image_id from event: could be a parameter
-    # or could be part of URL path ("pathParameters"):
+    # or could be part of URL path ("pathParameters");
+    # without one, list the most recent jobs
     if "image_id" in event:
       image_id = event["image_id"]
-    elif "pathParameters" in event:
-      if "image_id" in event["pathParameters"]:
-        image_id = event["pathParameters"]["image_id"]
-      else:
-        raise Exception("requires image_id parameter in pathParameters")
+    elif "image_id" in (event.get("pathParameters") or {}):
+      image_id = event["pathParameters"]["image_id"]
     else:
-        raise Exception("requires image_id parameter in event")
+      return list_recent(event)
         
-    print("image_id:", image_id)
+    trace.bind(image_id=image_id)
 
-    # open connection to the database:
-    #
-    print("**Opening connection**")
-    
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    job_id = as_image_id(image_id)
 
     #
-    # first we need to make sure the userid is valid:
+    # a finished job is answered from the cache; otherwise borrow a
+    # pooled connection to the database, where one query answers
+    # both the metadata and the prediction. In wait mode an
+    # unfinished job is then held until it finishes:
     #
-    print("**Checking if image_id is valid**")
-    
-    sql = "SELECT * FROM imageMetadata WHERE image_id = %s;"
-    
-    row = datatier.retrieve_one_row(dbConn, sql, [image_id])
+    wait = parse_wait(event)
+    result_cache = resultcache.cache()
+    if job_id is not None:
+      jobs, cache_hits = read_jobs(result_cache, [job_id])
+    else:
+      jobs, cache_hits = {}, 0
     
-    if not row:  # no such image
-      print("**No such image, returning...**")
+    if job_id not in jobs:  # no such image
+      trace.finish(400, error="no such image")
       return {
         'statusCode': 400,
         'body': json.dumps("no such image...")
       }
-    
-    print("image Requested:", image_id)
-    time_uploaded= row[1].isoformat() if row[1] else None
-    image_size= row[2]
-    file_name= row[3]
-    bucketkey= row[4]
-    
-    print("METADATA")
-    print(" time uploaded:", time_uploaded)
-    print(" image size:", image_size)
-    print(" original file name:", file_name)
-    print(" bucketkey:", bucketkey)
-    
-    s3 = boto3.client('s3')
-
-    # Retrieve the image data from S3
-    response = s3.get_object(Bucket=bucketname, Key=bucketkey)
 
-    # Extract binary data from the response
-    image_binary = response['Body'].read()
-
-    # Encode binary data to base64
-    base64_image = base64.b64encode(image_binary).decode('utf-8')
-    
-    print("image (first 10 chars):", base64_image[0:10])
+    waited = wait_for_jobs(result_cache, jobs, wait)
     
-    sql2 = "SELECT * FROM imagePredictions WHERE image_id = %s;"
+    bucketkey, results = jobs[job_id]
+    status = results["status"]
+    cache_fields = {'cache': 'hit' if cache_hits else 'miss',
+                    'waited': bool(waited),
+                    'cache_stats': result_cache.stats()}
     
-    row2 = datatier.retrieve_one_row(dbConn, sql2, [image_id])
+    trace.bind(bucket_key=bucketkey)
+    trace.event("job", **results)
     
-    if row2 == ():  # no such image
-      print("**No prediction stored, returning...**")
+    if status is None:  # no prediction row
+      trace.finish(400, error="no prediction")
       return {
         'statusCode': 400,
         'body': json.dumps("Something went wrong: no prediction...")
       }
     
-    precentage_ai= float(row2[2]) if row2[2] is not None else None
-    model_version= row2[3]
-    status= row2[4]
-    
-    print("PREDICTION")
-    print(" precentage_ai:", precentage_ai)
-    print(" model_version:", model_version)
-    print(" status:", status)
-    
-    results= {
-      "time_uploaded": time_uploaded,
-      "image_size":image_size,
-      "file_name":file_name,
-      "precentage_ai":precentage_ai,
-      "model_version":model_version,
-      "status":status,
-      "image":base64_image
-    }
-    
-    if status == 'pending':
-      print("**Job status pending, returning...**")
+    if status == 'error':
+      trace.finish(400, status=status)
       #
       return {
-        'statusCode': 200,
-        'body': json.dumps(results)
+        'statusCode': 400,
+        'body': json.dumps("error")
       }
-      
-    if status == 'error':
-      # return error 
-      if results_file_key == "":
-        print("**Image status unknown error, returning...**")
-        #
-        return {
-          'statusCode': 400,
-          'body': json.dumps("error")
-        }
     #
-    # either completed or something unexpected:
+    # either pending, completed or something unexpected:
     #
-    if status != "complete":
-      print("**Image status unexpected:", status)
-      print("**Returning...**")
-      #
+    if status not in ('pending', 'in_progress', 'complete'):
       msg = "ERROR: unexpected job status: " + status
       #
+      trace.finish(400, status=status, error=msg)
+      #
       return {
         'statusCode': 400,
         'body': json.dumps(msg)
       }
-      
-    # completed
+
+    mode = response_mode(event, status)
+    if mode not in response_modes:
+      trace.finish(400, error="unknown mode")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("mode must be one of: " + ", ".join(response_modes))
+      }
+
+    #
+    # the ETag only depends on the job state and the mode, so an
+    # unchanged job is answered before S3 is touched at all
+    #
+    etag = make_etag(image_id, results, mode)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+
+    if etag in [tag.strip() for tag in get_header(event, 'If-None-Match').split(",")]:
+      trace.finish(304, status=status, mode=mode, **cache_fields)
+      return {
+        'statusCode': 304,
+        'headers': headers,
+        'body': ""
+      }
+
+    if mode == 'url':
+      s3 = runtime.client('s3', s3_profile)
+      with tracelog.stage("s3.presign"):
+        results["image_url"] = presigned_image_url(s3, bucketname, bucketkey)
+        results["image_url_expires_in"] = image_url_expiration
+
+    elif mode == 'inline':
+      s3 = runtime.client('s3', s3_profile)
+
+      # Retrieve the image data from S3
+      with tracelog.stage("s3.get"):
+        response = s3.get_object(Bucket=bucketname, Key=bucketkey)
+
+        # Extract binary data from the response
+        image_binary = response['Body'].read()
+
+      # Encode binary data to base64
+      results["image"] = base64.b64encode(image_binary).decode('utf-8')
+
+    trace.finish(200, status=status, mode=mode, **cache_fields)
     return {
-    'statusCode': 200,
-    'body': json.dumps(results)
+      'statusCode': 200,
+      'headers': headers,
+      'body': json.dumps(results)
     }
     
   except Exception as err:
-    print("**ERROR**")
-    print(str(err))
+    trace.error(str(err), error_type=type(err).__name__)
+    trace.finish(400)
     
     return {
       'statusCode': 400,
@@ -1,178 +1,493 @@
-import json
-import boto3
+import io
 import os
+import json
 import uuid
 import base64
+import hashlib
 import pathlib
 import datatier
-from configparser import ConfigParser
+import runtime
+import tracelog
+
+# allow only png and jpeg extension types
+content_types = {
+'.png': 'image/png',
+'.jpg': 'image/jpeg',
+'.jpeg': 'image/jpeg',
+}
+
+# how long a presigned upload stays valid, in seconds
+upload_url_expiration = 900
+
+# most files accepted by one batch upload call
+max_batch_files = 1000
+
+# file_name and bucket_key are varchar(128); the bucket key adds about
+# 50 characters to the filename (see make_bucketkey)
+max_key_length = 128
+
+# model version new predictions are made with; an earlier upload's
+# result is only reused for an identical file if it came from this one
+model_version = os.environ.get('MODEL_VERSION', '1')
+
+# also treat images with equal perceptual hashes as duplicates; only
+# inline uploads can be hashed, as this lambda never sees the bytes of
+# presigned ones, and the hash costs a (reduced) decode per upload
+dedup_phash = os.environ.get('DEDUP_PHASH', '0') == '1'
+
+# deduplication lookups by this execution environment; the summary log
+# line reports them, and across environments the hit rate is e.g.
+#
+#   filter lambda = "upload" and msg = "done"
+#   | stats sum(dedup_hits) / (sum(dedup_hits) + sum(dedup_misses))
+#
+dedup_counts = {'hits': 0, 'misses': 0}
+
+def make_bucketkey(filename):
+  #
+  # generate unique filename in preparation for the S3 upload:
+  # all inputed images with same input extension for the trigger to work
+  #
+  extension = pathlib.Path(filename).suffix
+  return "inputImages" +"/"+filename +"-"+ str(uuid.uuid4())+ extension
+
+def content_digest(data):
+  return hashlib.sha256(data).hexdigest()
+
+def valid_digest(digest):
+  return isinstance(digest, str) and len(digest) == 64 and \
+    all(c in "0123456789abcdef" for c in digest)
+
+def image_phash(data):
+  #
+  # 64-bit difference hash: one bit per horizontal gradient of the
+  # image shrunk to 9x8 grayscale, so re-encoded or resized copies of
+  # an image hash the same. None if the image can't be decoded or
+  # Pillow isn't deployed with the lambda.
+  #
+  try:
+    from PIL import Image
+  except ImportError:
+    return None
+
+  try:
+    image = Image.open(io.BytesIO(data))
+    # JPEGs are decoded straight at 1/2 to 1/8 scale in grayscale,
+    # still well above the 9x8 needed
+    image.draft('L', (18, 16))
+    image = image.convert('L').resize((9, 8))
+  except Exception:
+    return None
+
+  pixels = list(image.getdata())
+  bits = 0
+  for row in range(8):
+    for col in range(8):
+      bits = (bits << 1) | (pixels[row*9 + col] > pixels[row*9 + col + 1])
+  return bits
+
+def find_duplicates(dbConn, column, values):
+  #
+  # completed predictions, by the current model version, of earlier
+  # uploads whose content_sha256 (or phash) is one of values; returns
+  # {value: response body}, the earliest upload winning
+  #
+  if not values:
+    return {}
+
+  sql = """
+  SELECT m.""" + column + """, m.image_id, p.precentage_ai, p.model_version
+  FROM imageMetadata m
+  JOIN imagePredictions p ON p.image_id = m.image_id
+  WHERE m.""" + column + " IN (" + ",".join(["%s"] * len(values)) + """)
+    AND p.status = 'complete' AND p.model_version = %s
+  ORDER BY m.image_id DESC;"""
+
+  with tracelog.stage("sql.find_duplicates"):
+    rows = datatier.retrieve_all_rows(dbConn, sql, list(values) + [model_version])
+
+  return {
+    value: {
+      'imageID': imageID,
+      'duplicate': True,
+      'status': 'complete',
+      'precentage_ai': float(precentage_ai),
+      'model_version': version
+    }
+    for value, imageID, precentage_ai, version in rows
+  }
+
+def count_dedup(hits, misses):
+  dedup_counts['hits'] += hits
+  dedup_counts['misses'] += misses
+  return {'dedup_hits': hits, 'dedup_misses': misses,
+          'dedup_totals': dict(dedup_counts)}
+
+def add_image_rows(dbConn, image_size, filename, bucketkey, digest=None, phash=None):
+  #
+  # add the metadata and pending prediction rows, returns the imageID
+  #
+  sql1="""
+  INSERT INTO imageMetadata(image_size, file_name, bucket_key, content_sha256, phash)
+  values(%s, %s,%s, %s, %s);"""
+
+  with tracelog.stage("sql.insert_metadata"):
+    datatier.perform_action(dbConn, sql1, [image_size, filename, bucketkey, digest, phash])
+
+  sql2 = "SELECT LAST_INSERT_ID();"
+
+  with tracelog.stage("sql.last_insert_id"):
+    row = datatier.retrieve_one_row(dbConn, sql2)
+
+  imageID = row[0]
+
+  tracelog.current().bind(image_id=imageID)
+
+  sql3="""
+  INSERT INTO imagePredictions(image_id, precentage_ai, status, model_version) values(%s,0,'pending',%s);"""
+  with tracelog.stage("sql.insert_prediction"):
+    datatier.perform_action(dbConn, sql3, [imageID, model_version])
+
+  return imageID
+
+def mark_failed(dbConn, imageID):
+  sql = "UPDATE imagePredictions SET status = 'error' WHERE image_id = %s;"
+
+  with tracelog.stage("sql.mark_failed"):
+    datatier.perform_action(dbConn, sql, [imageID])
+
+def add_image_rows_batch(dbConn, files):
+  #
+  # add the metadata and pending prediction rows for many files in one
+  # transaction: one multi-row INSERT per table plus one SELECT to map
+  # bucket keys back to the new image ids. files is a list of
+  # (image_size, filename, bucketkey, digest); returns
+  # {bucketkey: imageID}.
+  #
+  with tracelog.stage("sql.insert_batch"), runtime.transaction(dbConn) as dbCursor:
+    sql1 = """
+    INSERT INTO imageMetadata(image_size, file_name, bucket_key, content_sha256)
+    values """ + ",".join(["(%s,%s,%s,%s)"] * len(files)) + ";"
+
+    dbCursor.execute(sql1, [value for row in files for value in row])
+
+    # auto-increment ids of a multi-row insert are not guaranteed to be
+    # consecutive, so look them up by the (unique) bucket keys
+    bucketkeys = [row[2] for row in files]
+    sql2 = """
+    SELECT image_id, bucket_key FROM imageMetadata
+    WHERE bucket_key IN (""" + ",".join(["%s"] * len(files)) + ");"
+
+    dbCursor.execute(sql2, bucketkeys)
+    imageIDs = {bucketkey: imageID for imageID, bucketkey in dbCursor.fetchall()}
+
+    sql3 = """
+    INSERT INTO imagePredictions(image_id, precentage_ai, status, model_version)
+    values """ + ",".join(["(%s,0,'pending',%s)"] * len(files)) + ";"
+
+    dbCursor.execute(sql3, [value for bucketkey in bucketkeys
+                            for value in (imageIDs[bucketkey], model_version)])
+
+  return imageIDs
+
+def batch_upload(body, bucketname, s3_client):
+  #
+  # body is {"files": [{"filename": ..., "size": ..., "sha256": ...},
+  # ...]}, sha256 being optional; answers with one entry per file, in
+  # order, holding either its imageID and presigned upload, the
+  # finished result of an identical earlier upload, or an error. Bad
+  # entries don't fail the batch.
+  #
+  files = body["files"]
+
+  if not isinstance(files, list) or not files:
+    return {
+      'statusCode': 400,
+      'body': json.dumps("files must be a non-empty list")
+    }
+  if len(files) > max_batch_files:
+    return {
+      'statusCode': 400,
+      'body': json.dumps("at most " + str(max_batch_files) + " files per call")
+    }
+
+  results = []
+  accepted = []
+  for entry in files:
+    filename = entry.get("filename") if isinstance(entry, dict) else None
+    if not isinstance(filename, str):
+      filename = None
+    try:
+      image_size = int(entry["size"])
+    except Exception:
+      image_size = 0
+
+    extension = pathlib.Path(filename).suffix if filename else ""
+    bucketkey = make_bucketkey(filename) if filename else ""
+    if extension not in content_types:
+      results.append({'filename': filename, 'error': "Incorrect File Type"})
+    elif image_size <= 0:
+      results.append({'filename': filename, 'error': "size must be positive"})
+    elif len(bucketkey) > max_key_length:
+      # one over-long row would fail the whole multi-row insert
+      results.append({'filename': filename, 'error': "filename too long"})
+    else:
+      digest = entry.get("sha256")
+      results.append({'filename': filename})
+      accepted.append((len(results) - 1, image_size, filename, bucketkey,
+                       digest if valid_digest(digest) else None))
+
+  trace = tracelog.current()
+  trace.event("batch upload", files=len(files), accepted=len(accepted))
+
+  dedup = count_dedup(0, 0)
+  if accepted:
+    with runtime.db() as dbConn:
+      #
+      # files already scored need neither storage nor compute
+      #
+      digests = set(row[4] for row in accepted if row[4] is not None)
+      duplicates = find_duplicates(dbConn, 'content_sha256', digests)
+
+      new = []
+      for row in accepted:
+        if row[4] in duplicates:
+          results[row[0]].update(duplicates[row[4]])
+        else:
+          new.append(row)
+      hits = len(accepted) - len(new)
+      dedup = count_dedup(hits, len(new) - sum(1 for row in new if row[4] is None))
+
+      imageIDs = add_image_rows_batch(dbConn, [row[1:] for row in new]) if new else {}
+
+    with tracelog.stage("s3.presign"):
+      for index, image_size, filename, bucketkey, digest in new:
+        content_type = content_types[pathlib.Path(filename).suffix]
+        results[index]['imageID'] = imageIDs[bucketkey]
+        results[index]['upload'] = presigned_upload(s3_client, bucketname, bucketkey,
+                                                    content_type, image_size, digest)
+
+  trace.finish(200, files=len(files), accepted=len(accepted), **dedup)
+
+  return {
+    'statusCode': 200,
+    'body': json.dumps({'files': results})
+  }
+
+def presigned_upload(s3_client, bucketname, bucketkey, content_type, image_size, digest=None):
+  #
+  # a presigned POST the client can send the raw file bytes to; the
+  # policy pins the key, content type, ACL and exact size declared,
+  # and the SHA-256 if one was declared, so S3 rejects bytes that
+  # don't match the digest recorded for deduplication
+  #
+  fields = {
+    'acl': 'public-read',
+    'Content-Type': content_type,
+  }
+  if digest is not None:
+    fields['x-amz-checksum-sha256'] = base64.b64encode(bytes.fromhex(digest)).decode()
+
+  conditions = [{key: value} for key, value in fields.items()]
+  conditions.append(['content-length-range', image_size, image_size])
+
+  return s3_client.generate_presigned_post(
+    Bucket=bucketname,
+    Key=bucketkey,
+    Fields=fields,
+    Conditions=conditions,
+    ExpiresIn=upload_url_expiration
+  )
 
 def lambda_handler(event, context):
+  trace = tracelog.start('upload', context)
   try:
-    print("**STARTING**")
-    
-    #
-    # setup AWS based on config file:
-    #
-    config_file = 'config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
-    
+
     #
-    # configure for S3 access:
+    # config, S3 and RDS access are set up once per execution
+    # environment by runtime and reused by warm invocations:
     #
+    configur = runtime.config()
+
     s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
-    
     bucketname = configur.get('s3', 'bucket_name')
-    
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
-
-    #
-    # configure for RDS access
-    #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
 
     #
-    # the user has sent us two parameters:
+    # the user has sent us either "files", a list of
+    # {"filename", "size", "sha256"} entries for a batch upload, or
+    # these parameters:
     #  1. filename of their file
-    #  2. raw file data in base64 encoded string
+    #  2. either "size", the file size in bytes, to get a presigned
+    #     URL the file is then uploaded to directly, or "data", the
+    #     raw file data in base64 encoded string
+    #  3. optionally, with "size", "sha256": the hex SHA-256 of the
+    #     file, so an identical earlier upload can be reused
     #
-    # The parameters are coming through web server 
+    # The parameters are coming through web server
     # (or API Gateway) in the body of the request
     # in JSON format.
     #
-    print("**Accessing request body**")
-    
     if "body" not in event or not event["body"]:
-      print("Request body is empty or not provided")
+      trace.finish(400, error="empty or missing body")
       return {
         'statusCode': 400,
         'body': "Bad request: empty or missing body"
     }
-      
+
     body = json.loads(event["body"]) # parse the json
-    
+
+    #
+    # batch upload: many files declared in one call
+    #
+    if "files" in body:
+      s3_client = runtime.client('s3', s3_profile)
+      return batch_upload(body, bucketname, s3_client)
+
     if "filename" not in body:
       raise Exception("event has a body but no filename")
-    if "data" not in body:
-      raise Exception("event has a body but no data")
-    
-    # upload to S3:
-    #
+    if "data" not in body and "size" not in body:
+      raise Exception("event has a body but no data or size")
+
     filename = body["filename"]
-    datastr = body["data"]
-    
-    print("filename:", filename)
-    print("datastr (first 10 chars):", datastr[0:10])
-    base64_bytes = datastr.encode()        # string -> base64 bytes
-    bytes = base64.b64decode(base64_bytes) # base64 bytes -> raw bytes
-    
-    #
-    # write raw bytes to local filesystem for upload:
-    #
-    print("**Writing local data file**")
-    
     extension = pathlib.Path(filename).suffix
-    local_filename = "/tmp/data"+extension
-    
-    # allow only png and jpeg extension types
-    content_types = {
-    '.png': 'image/png',
-    '.jpg': 'image/jpeg',
-    '.jpeg': 'image/jpeg',
-    }
-    print("extension:",extension)
-    
+
+    trace.bind(file_name=filename)
+
     # return with error if incorrect type
     if extension in content_types:
        content_type = content_types[extension]
     else:
+      trace.finish(400, error="Incorrect File Type")
       return {
       'statusCode': 400,
       'body': json.dumps("Incorrect File Type")
       }
-    
-    outfile = open(local_filename, "wb")
-    outfile.write(bytes)
-    outfile.close()
-    
-    #
-    # generate unique filename in preparation for the S3 upload:
-    # all inputed images with same input extension for the trigger to work
+
+    bucketkey = make_bucketkey(filename)
+
+    if len(bucketkey) > max_key_length:
+      trace.finish(400, error="filename too long")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("filename too long")
+      }
+
+    trace.bind(bucket_key=bucketkey)
+
+    if "data" not in body:
+      #
+      # direct upload: create the rows first, so they exist by the
+      # time the object lands and triggers compute, then hand back a
+      # presigned POST for the raw bytes. This lambda never sees them.
+      #
+      image_size = int(body["size"])
+      if image_size <= 0:
+        trace.finish(400, error="size must be positive")
+        return {
+          'statusCode': 400,
+          'body': json.dumps("size must be positive")
+        }
+
+      digest = body.get("sha256")
+      if not valid_digest(digest):
+        digest = None
+
+      with runtime.db() as dbConn:
+        duplicate = find_duplicates(dbConn, 'content_sha256', [digest]).get(digest) \
+          if digest else None
+
+        if duplicate is not None:
+          trace.finish(200, mode="presigned", image_size=image_size,
+                       duplicate_of=duplicate['imageID'], **count_dedup(1, 0))
+          return {
+            'statusCode': 200,
+            'body': json.dumps(duplicate)
+          }
+
+        imageID = add_image_rows(dbConn, image_size, filename, bucketkey, digest)
+
+      s3_client = runtime.client('s3', s3_profile)
+      with tracelog.stage("s3.presign"):
+        upload = presigned_upload(s3_client, bucketname, bucketkey, content_type, image_size, digest)
+
+      trace.finish(200, mode="presigned", image_size=image_size,
+                   **count_dedup(0, 1 if digest else 0))
+
+      return {
+        'statusCode': 200,
+        'body': json.dumps({'imageID': imageID, 'upload': upload})
+      }
+
     #
-    print("**Uploading local file to S3**")
-    
-    basename = pathlib.Path(filename).stem
-    bucketkey = "inputImages" +"/"+filename +"-"+ str(uuid.uuid4())+ extension
-    
-    print("S3 bucketkey:", bucketkey)
-    
+    # inline upload: the file came base64 encoded in the body
     #
-    # finally, upload to S3:
+    datastr = body["data"]
+
+    base64_bytes = datastr.encode()        # string -> base64 bytes
+    data = base64.b64decode(base64_bytes)  # base64 bytes -> raw bytes
+
     #
-    print("**Uploading data file to S3**")
-
-    bucket.upload_file(local_filename, 
-                       bucketkey, 
-                       ExtraArgs={
-                         'ACL': 'public-read',
-                         'ContentType': content_type,
-                       })
-                       
-    # open connection to the database:
+    # an identical (or, with DEDUP_PHASH, perceptually identical)
+    # image that was already scored is answered without storing or
+    # computing anything:
     #
-    print("**Opening connection**")
-    
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    with tracelog.stage("hash"):
+      digest = content_digest(data)
+      phash = image_phash(data) if dedup_phash else None
 
-    # add the records into databases
-    #
-    print("**Adding row to database**")
+    with runtime.db() as dbConn:
+      duplicate = find_duplicates(dbConn, 'content_sha256', [digest]).get(digest)
+      if duplicate is None and phash is not None:
+        duplicate = find_duplicates(dbConn, 'phash', [phash]).get(phash)
 
-    sql1="""
-    INSERT INTO imageMetadata(image_size, file_name, bucket_key)
-    values(%s, %s,%s);"""
+      if duplicate is None:
+        #
+        # create the rows before storing the object, as for direct
+        # uploads, so they exist by the time it triggers compute
+        #
+        imageID = add_image_rows(dbConn, len(data), filename, bucketkey, digest, phash)
 
-    datatier.perform_action(dbConn, sql1, [os.path.getsize(local_filename), filename, bucketkey])
+    if duplicate is not None:
+      trace.finish(200, mode="inline", image_size=len(data),
+                   duplicate_of=duplicate['imageID'], **count_dedup(1, 0))
+      return {
+        'statusCode': 200,
+        'body': json.dumps(duplicate)
+      }
+
+    #
+    # finally, upload to S3:
+    #
+    s3 = runtime.resource('s3', s3_profile)
+    bucket = s3.Bucket(bucketname)
+    try:
+      with tracelog.stage("s3.put"):
+        bucket.put_object(Key=bucketkey,
+                          Body=data,
+                          ACL='public-read',
+                          ContentType=content_type)
+    except Exception:
+      # nothing will ever compute this job
+      with runtime.db() as dbConn:
+        mark_failed(dbConn, imageID)
+      raise
 
-    sql2 = "SELECT LAST_INSERT_ID();"
-    
-    row = datatier.retrieve_one_row(dbConn, sql2)
-    
-    imageID = row[0]
-    
-    print("imageID:", imageID)
-    
-    sql3="""
-    INSERT INTO imagePredictions(image_id, precentage_ai, status, model_version) values(%s,0,'pending',1);"""
-    datatier.perform_action(dbConn, sql3, [imageID])
-    
     # respond in an HTTP-like way, i.e. with a status
     # code and body in JSON format:
     #
-    print("**DONE**")
-    
-    response={
+    trace.finish(200, mode="inline", image_size=len(data), **count_dedup(0, 1))
+
+    return {
       'statusCode': 200,
       'body': json.dumps({'imageID': imageID})
     }
-    print("API Response:", response)
-    return response
-    
-    
+
+
   except Exception as err:
-    print("**ERROR**")
-    print(str(err))
-    
+    trace.error(str(err), error_type=type(err).__name__)
+    trace.finish(400)
+
     return {
       'statusCode': 400,
       'body': "uh-oh, something went wrong"
-    }
\ No newline at end of file
+    }
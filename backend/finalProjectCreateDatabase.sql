@@ -12,8 +12,12 @@ CREATE TABLE imageMetadata
     image_size        int not null,
     file_name     varchar(128) not null,
     bucket_key    varchar(128) not null,
+    content_sha256  char(64),         -- upload: finds identical earlier uploads
+    phash           bigint unsigned,  -- and, optionally, perceptually equal ones
     PRIMARY KEY (image_id),
-    UNIQUE      (bucket_key)
+    UNIQUE      (bucket_key),
+    INDEX       (content_sha256),
+    INDEX       (phash)
 );
 
 ALTER TABLE imageMetadata AUTO_INCREMENT = 00001;  -- starting value
@@ -24,9 +28,15 @@ CREATE TABLE imagePredictions
     image_id           int not null,
     precentage_ai      DECIMAL(7, 5) NOT NULL,
     model_version      varchar(128) not null,
-    status             ENUM('pending', 'complete', 'error') NOT NULL,
+    status             ENUM('pending', 'in_progress', 'complete', 'error') NOT NULL,
+    claimed_by         varchar(64),  -- worker.py: which worker holds the job
+    claimed_at         DATETIME,     -- and since when; old claims expire
+    attempts           int not null default 0,  -- failed scoring calls so far
     PRIMARY KEY (prediction_id),
-    FOREIGN KEY (image_id) REFERENCES imageMetadata(image_id)
+    FOREIGN KEY (image_id) REFERENCES imageMetadata(image_id),
+    INDEX (image_id),             -- retrieve: JOIN with imageMetadata
+    INDEX (status, claimed_at),
+    INDEX (status, image_id)      -- retrieve: newest jobs by status, keyset paged
 );
 
 ALTER TABLE imagePredictions AUTO_INCREMENT = 10001;  -- starting value
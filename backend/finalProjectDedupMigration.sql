@@ -0,0 +1,10 @@
+-- Adds the content hash columns used by upload deduplication to an
+-- existing database.
+
+USE AIartDetectionApp;
+
+ALTER TABLE imageMetadata
+  ADD COLUMN content_sha256 char(64),
+  ADD COLUMN phash bigint unsigned,
+  ADD INDEX (content_sha256),
+  ADD INDEX (phash);
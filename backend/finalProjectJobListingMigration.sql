@@ -0,0 +1,8 @@
+-- Adds the index used by the job listing to an existing database.
+-- Batch retrieve's JOIN uses the index InnoDB already keeps for the
+-- image_id foreign key.
+
+USE AIartDetectionApp;
+
+ALTER TABLE imagePredictions
+  ADD INDEX (status, image_id);
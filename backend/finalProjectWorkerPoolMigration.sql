@@ -0,0 +1,9 @@
+-- Adds the claim columns used by worker.py to an existing database.
+
+USE AIartDetectionApp;
+
+ALTER TABLE imagePredictions
+  MODIFY status ENUM('pending', 'in_progress', 'complete', 'error') NOT NULL,
+  ADD COLUMN claimed_by varchar(64),
+  ADD COLUMN claimed_at DATETIME,
+  ADD INDEX (status, claimed_at);
@@ -0,0 +1,7 @@
+-- Adds the attempt count worker.py keeps for jobs whose scoring call
+-- failed to an existing database.
+
+USE AIartDetectionApp;
+
+ALTER TABLE imagePredictions
+  ADD COLUMN attempts int not null default 0;
@@ -0,0 +1,272 @@
+#
+# Batched scoring and bulk result writes, shared by the compute lambda
+# and the pending-job worker pool (worker.py).
+#
+
+import os
+import json
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from urllib3 import encode_multipart_formdata
+
+import tracelog
+import resultcache
+
+sage_maker_endpoint_name = 'artifact-v6'
+
+# precentage_ai is DECIMAL(7, 5), so 100 itself does not fit
+max_percentage = 99.99999
+
+# SageMaker rejects request bodies over 6 MB (real-time endpoints) or
+# 4 MB (serverless), so images are sent in as many calls as it takes
+# to keep every body under this; 256 images per call keeps the
+# response (with return_inputs, about 4 KB per image) small as well
+max_request_bytes = int(os.environ.get('SAGEMAKER_MAX_REQUEST_BYTES', 4000000))
+max_images_per_request = 256
+
+# multipart framing: headers and boundary around each part, and the
+# closing boundary
+part_overhead = 256
+body_overhead = 64
+
+# most of one batch's calls in flight at once
+max_concurrent_requests = 4
+
+# where the preprocessed model input of inputImages/<name> is kept:
+# modelInputs/<name>.npy, outside the prefix/suffix that triggers compute
+model_inputs_prefix = 'modelInputs/'
+
+
+class ModelInput(bytes):
+    """
+    A stored model input: .npy bytes of the (3, 32, 32) uint8 array
+    the endpoint would otherwise decode and resize the original image
+    into. Passed to invoke_endpoint_batch in place of an image, it is
+    sent as application/x-npy and skips decoding entirely.
+    """
+
+
+def model_input_key(bucket_key):
+    return model_inputs_prefix + bucket_key.split('/', 1)[-1] + '.npy'
+
+
+def fetch_model_input(s3_client, bucketname, bucket_key):
+    """
+    The stored model input of an image, or None if it has none yet.
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucketname, Key=model_input_key(bucket_key))
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    return ModelInput(response['Body'].read())
+
+
+def store_model_input(s3_client, bucketname, bucket_key, model_input):
+    s3_client.put_object(Bucket=bucketname,
+                         Key=model_input_key(bucket_key),
+                         Body=model_input,
+                         ContentType='application/x-npy')
+
+
+def to_percentage_ai(probability_real):
+    #
+    # the endpoint returns the probability of the image being real
+    #
+    return min(round(100*(1-probability_real), 5), max_percentage)
+
+
+def request_chunks(images):
+    """
+    Splits the positions of images into consecutive runs whose
+    multipart body fits in max_request_bytes. Returns (chunks,
+    too_large), too_large being the images that don't fit on their own.
+    """
+    chunks = []
+    too_large = []
+    chunk = []
+    size = body_overhead
+    for i, image in enumerate(images):
+        part = len(image) + part_overhead
+        if body_overhead + part > max_request_bytes:
+            too_large.append(i)
+            continue
+        if chunk and (size + part > max_request_bytes or len(chunk) == max_images_per_request):
+            chunks.append(chunk)
+            chunk = []
+            size = body_overhead
+        chunk.append(i)
+        size += part
+    if chunk:
+        chunks.append(chunk)
+    return chunks, too_large
+
+
+def invoke_endpoint_batch(sagemaker_runtime, images, model_version=None, return_inputs=False):
+    """
+    Scores a list of encoded images (or ModelInputs) with SageMaker,
+    sent as multipart bodies of raw bytes in as few calls as
+    max_request_bytes allows. Returns a list, in order, of
+    (percentage_ai, None) or (None, error message) per image, or None
+    for an image whose call failed: the endpoint never saw it, so it
+    can be retried. An image too large to send at all gets an error.
+
+    With return_inputs, returns (scored, model_inputs) instead, where
+    model_inputs holds each image's ModelInput as computed by the
+    endpoint (None where it failed), ready to be stored.
+    """
+    scored = [None] * len(images)
+    model_inputs = [None] * len(images)
+
+    chunks, too_large = request_chunks(images)
+    for i in too_large:
+        scored[i] = (None, "image is larger than the endpoint's %d byte request limit"
+                     % max_request_bytes)
+
+    def invoke(chunk):
+        try:
+            return invoke_endpoint(sagemaker_runtime, [images[i] for i in chunk],
+                                   model_version, return_inputs), None
+        except Exception as e:
+            return None, e
+
+    # timed here, once, as the calls may run concurrently
+    with tracelog.stage("sagemaker.invoke"):
+        if len(chunks) == 1:
+            results = [invoke(chunks[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=max_concurrent_requests) as pool:
+                results = list(pool.map(invoke, chunks))
+
+    for chunk, (result, error) in zip(chunks, results):
+        if error is not None:
+            tracelog.current().error("Error invoking SageMaker endpoint: " + str(error),
+                                     image_count=len(chunk))
+            continue
+        chunk_scored, chunk_inputs = result
+        for i, entry, model_input in zip(chunk, chunk_scored, chunk_inputs):
+            scored[i] = entry
+            model_inputs[i] = model_input
+
+    if not return_inputs:
+        return scored
+    return scored, model_inputs
+
+
+def invoke_endpoint(sagemaker_runtime, images, model_version, return_inputs):
+    """
+    One SageMaker call for images; returns (scored, model_inputs) as
+    invoke_endpoint_batch does, and raises if the call fails.
+    """
+    fields = [("image", (str(i), image, "application/x-npy"
+                         if isinstance(image, ModelInput) else "application/x-image"))
+              for i, image in enumerate(images)]
+    body, content_type = encode_multipart_formdata(fields)
+
+    attributes = []
+    if model_version is not None:
+        attributes.append('model_version=' + str(model_version))
+    if return_inputs:
+        attributes.append('return_inputs=1')
+
+    kwargs = {}
+    if attributes:
+        kwargs['CustomAttributes'] = ','.join(attributes)
+
+    response = sagemaker_runtime.invoke_endpoint(
+        EndpointName=sage_maker_endpoint_name,
+        ContentType=content_type,
+        Body=body,
+        **kwargs
+    )
+    result = json.loads(response['Body'].read().decode())
+
+    scored = []
+    for prob, error in zip(result["probabilities_real"], result["errors"]):
+        if prob is None:
+            scored.append((None, error or "inference failed"))
+        else:
+            scored.append((to_percentage_ai(prob), None))
+
+    model_inputs = [None if model_input is None else
+                    ModelInput(base64.b64decode(model_input))
+                    for model_input in result.get("model_inputs", [None] * len(scored))]
+    return scored, model_inputs
+
+
+def resolve_image_ids(dbConn, bucketkeys):
+    """
+    Maps bucket keys to image ids with one query; keys without a
+    metadata row are left out.
+    """
+    if not bucketkeys:
+        return {}
+
+    sql = "SELECT image_id, bucket_key FROM imageMetadata WHERE bucket_key IN (" + \
+        ",".join(["%s"] * len(bucketkeys)) + ");"
+
+    dbCursor = dbConn.cursor()
+    try:
+        with tracelog.stage("sql.select_image_ids"):
+            dbCursor.execute(sql, list(bucketkeys))
+        return {bucketkey: image_id for image_id, bucketkey in dbCursor.fetchall()}
+    finally:
+        dbCursor.close()
+
+
+def write_predictions(dbConn, results, claimed_by=None, model_version=None):
+    """
+    Writes many (image_id, precentage_ai, status) results with a
+    single UPDATE, drops any cached earlier result of those jobs and
+    publishes the statuses for retrieve's waiters (see
+    resultcache.py). Returns the number of rows changed.
+
+    With model_version, the rows also record which model scored them.
+
+    With claimed_by, only rows still claimed by that worker are
+    written (and their claim is cleared), so a worker whose claim
+    expired and was taken over cannot overwrite the new owner.
+    """
+    if not results:
+        return 0
+
+    ids = [image_id for image_id, _, _ in results]
+
+    sql = "UPDATE imagePredictions SET precentage_ai = CASE image_id " + \
+        " ".join(["WHEN %s THEN %s"] * len(results)) + \
+        " END, status = CASE image_id " + \
+        " ".join(["WHEN %s THEN %s"] * len(results)) + " END"
+    if model_version is not None:
+        sql += ", model_version = %s"
+    if claimed_by is not None:
+        sql += ", claimed_by = NULL, claimed_at = NULL"
+    sql += " WHERE image_id IN (" + ",".join(["%s"] * len(results)) + ")"
+    if claimed_by is not None:
+        sql += " AND claimed_by = %s"
+    sql += ";"
+
+    params = []
+    for image_id, percentage, _ in results:
+        params += [image_id, percentage]
+    for image_id, _, status in results:
+        params += [image_id, status]
+    if model_version is not None:
+        params.append(str(model_version))
+    params += ids
+    if claimed_by is not None:
+        params.append(claimed_by)
+
+    dbCursor = dbConn.cursor()
+    try:
+        with tracelog.stage("sql.update_predictions"):
+            dbCursor.execute(sql, params)
+            dbConn.commit()
+        written = dbCursor.rowcount
+    finally:
+        dbCursor.close()
+
+    with tracelog.stage("cache.update"):
+        result_cache = resultcache.cache()
+        result_cache.invalidate(ids)
+        result_cache.publish_statuses(
+            {image_id: status for image_id, _, status in results})
+    return written
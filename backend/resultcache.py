@@ -0,0 +1,265 @@
+#
+# Read-through cache of finished retrieve results.
+#
+# A prediction that reached 'complete' never changes, so retrieve keeps
+# its metadata and prediction here and answers repeat requests without
+# going to RDS. Two tiers:
+#
+#   1. an LRU in the lambda's own memory, bounded by entry count and
+#      age, shared by warm invocations of one execution environment;
+#   2. optionally a Redis-protocol key-value store shared by all
+#      execution environments, set with RESULT_CACHE_URL, e.g.
+#      redis://my-cache.xxxx.cache.amazonaws.com:6379/0. Any server
+#      speaking the protocol works, so a local redis-server stands in
+#      for ElastiCache during development.
+#
+# Only complete results are ever stored; pending jobs always read
+# through. The shared tier is best-effort: when it is unreachable the
+# lambda carries on with the database and counts an error.
+#
+# A job can be scored again (see worker.py), so entries are keyed by
+# the model version being served (MODEL_VERSION, as for upload) and
+# only results made by that version are stored: moving to a new model
+# leaves every old entry behind at once. When a prediction is rewritten
+# under the same version, write_predictions drops its shared entry, and
+# in-memory entries in other execution environments, which can't be
+# reached, live at most RESULT_CACHE_LOCAL_TTL (default 60) seconds.
+#
+# RESULT_CACHE_SIZE (default 4096 entries) and RESULT_CACHE_TTL (default
+# 3600 seconds) bound both tiers. Hit and miss counters are kept per
+# execution environment and reported in retrieve's summary log line.
+#
+# The shared tier also carries job statuses for retrieve's wait mode
+# (see statuswatch.py): compute and worker.py publish each status they
+# write, for status_ttl seconds, which is only as long as a waiter
+# could need it.
+#
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+key_prefix = 'artifact:result:'
+status_prefix = 'artifact:status:'
+
+status_ttl = 60
+
+
+class LRUCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if time.monotonic() >= expires:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedCache:
+    """
+    The shared tier, on any Redis-protocol server. redis is imported
+    here so the lambdas only need the package when this tier is on.
+    """
+
+    def __init__(self, url, ttl, timeout=0.2):
+        import redis
+
+        self.ttl = ttl
+        self.client = redis.Redis.from_url(
+            url, socket_timeout=timeout, socket_connect_timeout=timeout)
+
+    def get_many(self, keys):
+        values = self.client.mget([key_prefix + str(key) for key in keys])
+        return {key: json.loads(value) for key, value in zip(keys, values)
+                if value is not None}
+
+    def set_many(self, items):
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipe.set(key_prefix + str(key), json.dumps(value), ex=self.ttl)
+        pipe.execute()
+
+    def delete_many(self, keys):
+        self.client.delete(*[key_prefix + str(key) for key in keys])
+
+    def get_statuses(self, keys):
+        values = self.client.mget([status_prefix + str(key) for key in keys])
+        return {key: value.decode() for key, value in zip(keys, values)
+                if value is not None}
+
+    def set_statuses(self, statuses):
+        pipe = self.client.pipeline(transaction=False)
+        for key, status in statuses.items():
+            pipe.set(status_prefix + str(key), status, ex=status_ttl)
+        pipe.execute()
+
+    def delete_statuses(self, keys):
+        self.client.delete(*[status_prefix + str(key) for key in keys])
+
+
+class ResultCache:
+    def __init__(self, max_entries=4096, ttl=3600, shared=None, version='1', local_ttl=60):
+        self.local = LRUCache(max_entries, min(ttl, local_ttl))
+        self.shared = shared
+        self.version = version
+        self.counters = {'local_hits': 0, 'shared_hits': 0, 'misses': 0,
+                         'stores': 0, 'shared_errors': 0}
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def versioned(self, key):
+        return self.version + ':' + str(key)
+
+    def get_many(self, keys):
+        """
+        {key: value} for the keys found in either tier; shared hits
+        are copied into the local tier. Values are kept serialized, so
+        callers get their own copy to modify.
+        """
+        found = {}
+        for key in keys:
+            value = self.local.get(self.versioned(key))
+            if value is not None:
+                found[key] = json.loads(value)
+        self.count('local_hits', len(found))
+
+        missing = [key for key in keys if key not in found]
+        if missing and self.shared is not None:
+            try:
+                shared = self.shared.get_many([self.versioned(key) for key in missing])
+            except Exception:
+                self.count('shared_errors')
+                shared = {}
+            for key in missing:
+                value = shared.get(self.versioned(key))
+                if value is not None:
+                    self.local.set(self.versioned(key), json.dumps(value))
+                    found[key] = value
+            self.count('shared_hits', len(shared))
+
+        self.count('misses', len(keys) - len(found))
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set_many(self, items):
+        if not items:
+            return
+        for key, value in items.items():
+            self.local.set(self.versioned(key), json.dumps(value))
+        if self.shared is not None:
+            try:
+                self.shared.set_many({self.versioned(key): value
+                                      for key, value in items.items()})
+            except Exception:
+                self.count('shared_errors')
+        self.count('stores', len(items))
+
+    def invalidate(self, keys):
+        """
+        Drops the entries of jobs whose prediction is being rewritten.
+        """
+        if not keys:
+            return
+        for key in keys:
+            self.local.delete(self.versioned(key))
+        if self.shared is not None:
+            try:
+                self.shared.delete_many([self.versioned(key) for key in keys])
+            except Exception:
+                self.count('shared_errors')
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def get_statuses(self, keys):
+        """
+        {key: status} for the jobs whose status was published; empty
+        without a shared tier.
+        """
+        if self.shared is None or not keys:
+            return {}
+        try:
+            return self.shared.get_statuses(keys)
+        except Exception:
+            self.count('shared_errors')
+            return {}
+
+    def publish_statuses(self, statuses):
+        if self.shared is None or not statuses:
+            return
+        try:
+            self.shared.set_statuses(statuses)
+        except Exception:
+            self.count('shared_errors')
+
+    def forget_statuses(self, keys):
+        # for jobs that are being scored (again)
+        if self.shared is None or not keys:
+            return
+        try:
+            self.shared.delete_statuses(keys)
+        except Exception:
+            self.count('shared_errors')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = round((lookups - stats['misses']) / lookups, 4) if lookups else None
+        stats['local_entries'] = len(self.local)
+        return stats
+
+
+_cache = None
+_lock = threading.Lock()
+
+
+def cache():
+    """
+    The execution environment's cache, configured from the
+    environment on first use.
+    """
+    global _cache
+
+    with _lock:
+        if _cache is None:
+            ttl = int(os.environ.get('RESULT_CACHE_TTL', '3600'))
+            url = os.environ.get('RESULT_CACHE_URL')
+            _cache = ResultCache(
+                max_entries=int(os.environ.get('RESULT_CACHE_SIZE', '4096')),
+                ttl=ttl,
+                shared=SharedCache(url, ttl) if url else None,
+                version=os.environ.get('MODEL_VERSION', '1'),
+                local_ttl=int(os.environ.get('RESULT_CACHE_LOCAL_TTL', '60')))
+        return _cache
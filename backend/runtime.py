@@ -0,0 +1,190 @@
+#
+# Per-execution-environment state shared by the upload, compute and
+# retrieve lambdas.
+#
+# Everything here is built on first use and then kept at module level,
+# so warm invocations reuse the parsed config.ini, the boto3 sessions
+# and clients (and their open TLS connections), and the database
+# connections instead of re-creating them on every request.
+#
+
+import os
+import threading
+import time
+from configparser import ConfigParser
+from contextlib import contextmanager
+
+import boto3
+import datatier
+
+CONFIG_FILE = 'config.ini'
+
+_lock = threading.RLock()
+_config = None
+_sessions = {}
+_clients = {}
+_resources = {}
+_pool = None
+
+
+def config(config_file=None):
+    """
+    The parsed config.ini. A long-running process (see worker.py) may
+    pass a different file on the first call.
+    """
+    global _config, CONFIG_FILE
+
+    with _lock:
+        if _config is None:
+            if config_file is not None:
+                CONFIG_FILE = config_file
+            os.environ['AWS_SHARED_CREDENTIALS_FILE'] = CONFIG_FILE
+
+            configur = ConfigParser()
+            configur.read(CONFIG_FILE)
+            _config = configur
+
+        return _config
+
+
+def session(profile):
+    config()  # credentials live in config.ini
+
+    with _lock:
+        if profile not in _sessions:
+            _sessions[profile] = boto3.Session(profile_name=profile)
+        return _sessions[profile]
+
+
+def client(service, profile):
+    with _lock:
+        key = (service, profile)
+        if key not in _clients:
+            _clients[key] = session(profile).client(service)
+        return _clients[key]
+
+
+def resource(service, profile):
+    with _lock:
+        key = (service, profile)
+        if key not in _resources:
+            _resources[key] = session(profile).resource(service)
+        return _resources[key]
+
+
+class ConnectionPool:
+    """
+    A small pool of MySQL connections that survives across warm
+    invocations.
+
+    Connections are opened through datatier with autocommit on, so a
+    reused connection never carries an open read snapshot from an
+    earlier invocation into the next one. A connection that has been
+    idle longer than check_after seconds is pinged (and transparently
+    reconnected) before it is handed out, and a connection whose
+    driver raised while in use is thrown away rather than returned to
+    the pool.
+    """
+
+    def __init__(self, connect, max_size=2, check_after=30):
+        self.connect = connect
+        self.max_size = max_size
+        self.check_after = check_after
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        dbConn = self.connect()
+        dbConn.autocommit(True)
+        return dbConn
+
+    def acquire(self):
+        with self._lock:
+            entry = self._idle.pop() if self._idle else None
+
+        if entry is None:
+            return self._open()
+
+        dbConn, idle_since = entry
+        if time.monotonic() - idle_since > self.check_after:
+            try:
+                dbConn.ping(reconnect=True)
+            except Exception:
+                self.discard(dbConn)
+                return self._open()
+        return dbConn
+
+    def release(self, dbConn):
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((dbConn, time.monotonic()))
+                return
+        self.discard(dbConn)
+
+    def discard(self, dbConn):
+        try:
+            dbConn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self):
+        dbConn = self.acquire()
+        try:
+            yield dbConn
+        except Exception as err:
+            # driver/socket errors may leave the connection unusable;
+            # anything else (a missing row, bad input) does not
+            if isinstance(err, OSError) or \
+               type(err).__module__.startswith('pymysql'):
+                self.discard(dbConn)
+            else:
+                self.release(dbConn)
+            raise
+        self.release(dbConn)
+
+
+@contextmanager
+def transaction(dbConn):
+    """
+    with runtime.transaction(dbConn) as dbCursor: ... -- runs the
+    block's statements as one transaction on a pooled (autocommit)
+    connection, committing at the end or rolling back on error.
+    """
+    dbConn.begin()
+    dbCursor = dbConn.cursor()
+    try:
+        yield dbCursor
+        dbConn.commit()
+    except Exception:
+        dbConn.rollback()
+        raise
+    finally:
+        dbCursor.close()
+
+
+def db_pool():
+    global _pool
+
+    with _lock:
+        if _pool is None:
+            configur = config()
+
+            rds_endpoint = configur.get('rds', 'endpoint')
+            rds_portnum = int(configur.get('rds', 'port_number'))
+            rds_username = configur.get('rds', 'user_name')
+            rds_pwd = configur.get('rds', 'user_pwd')
+            rds_dbname = configur.get('rds', 'db_name')
+
+            _pool = ConnectionPool(lambda: datatier.get_dbConn(
+                rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname))
+
+        return _pool
+
+
+def db():
+    """
+    with runtime.db() as dbConn: ... -- a pooled, health-checked
+    connection for the duration of the block.
+    """
+    return db_pool().connection()
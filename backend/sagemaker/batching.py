@@ -0,0 +1,145 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+import metrics
+from preprocess import fill_batch
+
+
+class MicroBatcher:
+    """
+    Merges concurrent single-image requests into one forward pass.
+
+    Callers submit a (3, 32, 32) uint8 model input and get a Future
+    back. A single worker thread takes the first queued image, keeps
+    collecting until it has max_batch_size images or max_wait_ms has
+    passed, fills them into a preallocated float32 NCHW buffer, runs
+    them through the model as one batch and resolves each caller's
+    Future with its own probability.
+    """
+
+    def __init__(self, registry, max_batch_size=32, max_wait_ms=5):
+        self.registry = registry
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self._queue = queue.Queue()
+        self._buffer = np.empty((self.max_batch_size, 3, 32, 32),
+                                dtype=np.float32)
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="micro-batcher",
+                                                daemon=True)
+                self._thread.start()
+
+    def submit(self, image, model_version=None):
+        # fail fast on bad input or an unknown model_version, so one bad
+        # request can't fail the whole batch it would have joined
+        if tuple(image.shape) != (3, 32, 32):
+            raise ValueError("expected a 3x32x32 image, got " +
+                             "x".join(str(d) for d in image.shape))
+        self.registry.get(model_version)
+        self.start()
+
+        future = Future()
+        self._queue.put((image, model_version, future, time.perf_counter()))
+        return future
+
+    def stop(self, timeout=None):
+        """
+        Finishes everything already queued, then stops the worker
+        thread. Used for graceful shutdown.
+        """
+        with self._start_lock:
+            thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+
+        with self._start_lock:
+            if self._thread is thread:
+                self._thread = None
+
+    def _collect(self):
+        """
+        Returns (batch, stopping); a None in the queue asks the worker
+        to stop once the images queued ahead of it are done.
+        """
+        first = self._queue.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._collect()
+
+            # requests for different model versions can share a window
+            # but not a forward pass
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[1], []).append(item)
+
+            for model_version, items in groups.items():
+                self._forward(model_version, items)
+
+    def _forward(self, model_version, items):
+        futures = [item[2] for item in items]
+        started = time.perf_counter()
+
+        for item in items:
+            metrics.STAGE_SECONDS.observe(started - item[3],
+                                          stage="queue_wait")
+        metrics.BATCH_SIZE.observe(len(items))
+
+        try:
+            model = self.registry.get(model_version)
+
+            batch = fill_batch([item[0] for item in items], self._buffer)
+            filled = time.perf_counter()
+            probs = model(batch).tolist()
+
+            metrics.STAGE_SECONDS.observe(filled - started,
+                                          stage="to_tensor")
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - filled,
+                                          stage="forward")
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for future, prob in zip(futures, probs):
+            future.set_result(prob)
+
+
+def batcher_from_env(registry):
+    return MicroBatcher(registry,
+                        max_batch_size=os.environ.get("MAX_BATCH_SIZE", 32),
+                        max_wait_ms=os.environ.get("MAX_BATCH_WAIT_MS", 5))
@@ -0,0 +1,401 @@
+import argparse
+import base64
+import http.client
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+# Load and benchmark driver for the inference container.
+#
+#   python benchmark.py http --concurrency 16 --duration 30
+#   python benchmark.py http --rate 200 --url http://localhost:8080
+#   python benchmark.py inprocess --concurrency 8 --requests 2000
+#
+# "http" starts serve.py locally (unless --url is given) and drives
+# /invocations over keep-alive connections; "inprocess" imports
+# inference.py and scores images without HTTP, so model and
+# preprocessing regressions can be told apart from server overhead.
+# Both print one JSON report; --output also writes it to a file.
+
+SYNTHETIC_SIZES = (32, 224, 1024, 4000)
+SYNTHETIC_FORMATS = (("JPEG", "RGB"), ("PNG", "RGB"), ("PNG", "RGBA"),
+                     ("PNG", "L"), ("PNG", "P"))
+
+
+def synthetic_corpus(seed=0):
+    """
+    Mixed sizes and formats, including the RGBA, grayscale and palette
+    images the old preprocessing choked on. Returns (name, bytes).
+    """
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    corpus = []
+    for size in SYNTHETIC_SIZES:
+        for fmt, mode in SYNTHETIC_FORMATS:
+            # smooth upscaled noise, so PNGs compress like photos do
+            pixels = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+            image = Image.fromarray(pixels, "RGB").resize((size, size),
+                                                          Image.BILINEAR)
+            if mode == "P":
+                image = image.quantize(64)
+            elif mode != "RGB":
+                image = image.convert(mode)
+            buffer = io.BytesIO()
+            image.save(buffer, fmt)
+            corpus.append(("%dpx-%s-%s" % (size, mode, fmt.lower()),
+                           buffer.getvalue()))
+    return corpus
+
+
+def load_corpus(image_dir):
+    corpus = []
+    for name in sorted(os.listdir(image_dir)):
+        path = os.path.join(image_dir, name)
+        if os.path.isfile(path):
+            with open(path, "rb") as infile:
+                corpus.append((name, infile.read()))
+    if not corpus:
+        raise ValueError("no images in " + image_dir)
+    return corpus
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1,
+                max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, images_per_request, elapsed):
+    latencies = sorted(latencies)
+    total = len(latencies) + sum(errors.values())
+    return {
+        "requests": total,
+        "errors": sum(errors.values()),
+        "error_rate": sum(errors.values()) / total if total else 0.0,
+        "errors_by_type": errors,
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "throughput_images_per_s":
+            len(latencies) * images_per_request / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": 1000.0 * sum(latencies) / len(latencies)
+            if latencies else None,
+            "p50": _ms(percentile(latencies, 0.50)),
+            "p90": _ms(percentile(latencies, 0.90)),
+            "p95": _ms(percentile(latencies, 0.95)),
+            "p99": _ms(percentile(latencies, 0.99)),
+            "max": _ms(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else 1000.0 * seconds
+
+
+class Driver:
+    """
+    Calls fn(i) either as fast as `concurrency` threads allow (closed
+    loop) or at a fixed `rate` per second (open loop), until
+    `requests` calls or `duration` seconds. fn raises to record an
+    error, keyed by its exception type.
+    """
+
+    def __init__(self, fn, concurrency, rate=None, requests=None,
+                 duration=None):
+        self.fn = fn
+        self.concurrency = concurrency
+        self.rate = rate
+        self.requests = requests
+        self.duration = duration if duration or requests else 10.0
+
+        self.latencies = []
+        self.errors = {}
+        self._lock = threading.Lock()
+        self._issued = 0
+
+    def _next(self):
+        with self._lock:
+            if self.requests is not None and self._issued >= self.requests:
+                return None
+            self._issued += 1
+            return self._issued - 1
+
+    def _call(self, i, scheduled=None):
+        started = time.perf_counter()
+        try:
+            self.fn(i)
+        except Exception as e:
+            with self._lock:
+                name = type(e).__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+            return
+        # open loop latency counts from when the request was due, so
+        # queueing behind a slow server is not hidden
+        latency = time.perf_counter() - (scheduled or started)
+        with self._lock:
+            self.latencies.append(latency)
+
+    def run(self):
+        started = time.perf_counter()
+        deadline = started + self.duration if self.duration else None
+
+        if self.rate:
+            with ThreadPoolExecutor(self.concurrency) as pool:
+                interval = 1.0 / self.rate
+                n = 0
+                while True:
+                    scheduled = started + n * interval
+                    if deadline and scheduled >= deadline:
+                        break
+                    i = self._next()
+                    if i is None:
+                        break
+                    delay = scheduled - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    pool.submit(self._call, i, scheduled)
+                    n += 1
+        else:
+            def loop():
+                while not deadline or time.perf_counter() < deadline:
+                    i = self._next()
+                    if i is None:
+                        return
+                    self._call(i)
+
+            threads = [threading.Thread(target=loop)
+                       for _ in range(self.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        return time.perf_counter() - started
+
+
+def encode_request(images, content_type):
+    """
+    Builds (body, content type header) for one /invocations call in
+    one of the formats the server accepts.
+    """
+    if content_type == "raw":
+        return images[0], "application/x-image"
+
+    if content_type == "json":
+        if len(images) == 1:
+            body = {"image": base64.b64encode(images[0]).decode()}
+        else:
+            body = {"images": [base64.b64encode(image).decode()
+                               for image in images]}
+        return json.dumps(body).encode(), "application/json"
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    for i, image in enumerate(images):
+        parts.append(("--%s\r\nContent-Disposition: form-data; "
+                      "name=\"image\"; filename=\"%d\"\r\nContent-Type: "
+                      "application/x-image\r\n\r\n" % (boundary, i)).encode())
+        parts.append(image)
+        parts.append(b"\r\n")
+    parts.append(("--%s--\r\n" % boundary).encode())
+    return b"".join(parts), "multipart/form-data; boundary=" + boundary
+
+
+def wait_until_ready(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=2)
+            conn.request("GET", "/ping")
+            status = conn.getresponse().status
+            conn.close()
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError("server not ready after %ss" % timeout)
+
+
+def run_http(args, corpus):
+    server = None
+    url = urlparse(args.url or "http://127.0.0.1:%d" % args.port)
+
+    if not args.url:
+        env = dict(os.environ, PORT=str(args.port),
+                   SERVER_MODE=args.server)
+        here = os.path.dirname(os.path.abspath(__file__))
+        server = subprocess.Popen([sys.executable, "serve.py"], cwd=here,
+                                  env=env, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+
+    try:
+        started = time.perf_counter()
+        wait_until_ready(url.hostname, url.port or 80, args.ready_timeout)
+        ready_s = time.perf_counter() - started
+
+        # one keep-alive connection per driver thread
+        local = threading.local()
+        requests = [encode_request([corpus[(i + j) % len(corpus)][1]
+                                    for j in range(args.batch)],
+                                   args.content_type)
+                    for i in range(len(corpus))]
+
+        def call(i):
+            conn = getattr(local, "conn", None)
+            if conn is None:
+                conn = local.conn = http.client.HTTPConnection(
+                    url.hostname, url.port or 80, timeout=60)
+            body, content_type = requests[i % len(requests)]
+            try:
+                conn.request("POST", "/invocations", body,
+                             {"Content-Type": content_type})
+                response = conn.getresponse()
+                payload = response.read()
+            except Exception:
+                conn.close()
+                local.conn = None
+                raise
+            if response.status != 200:
+                raise RuntimeError("HTTP %d" % response.status)
+            result = json.loads(payload)
+            if any(e is not None for e in result.get("errors", ())):
+                raise ValueError("image error in batch")
+
+        driver = Driver(call, args.concurrency, args.rate, args.requests,
+                        args.duration)
+        elapsed = driver.run()
+        report = summarize(driver.latencies, driver.errors, args.batch,
+                           elapsed)
+        if server is not None:
+            report["server_ready_s"] = ready_s
+        return report
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+
+def run_inprocess(args, corpus):
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, here)
+    os.chdir(here)
+
+    import inference
+
+    started = time.perf_counter()
+    inference.load_models()
+    load_s = time.perf_counter() - started
+
+    # preprocessing alone, single-threaded, per corpus entry
+    preprocess_ms = {}
+    for name, image_bytes in corpus:
+        timings = {}
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            inference.preprocess.preprocess(image_bytes, timings)
+        preprocess_ms[name] = 1000.0 * (time.perf_counter() - started) / \
+            args.repeat
+
+    inputs = [inference.preprocess.preprocess(image_bytes)
+              for _, image_bytes in corpus]
+
+    # end-to-end scoring through the micro-batcher, without HTTP
+    def call(i):
+        model_input = inference.preprocess.preprocess(
+            corpus[i % len(corpus)][1])
+        inference.batcher.submit(model_input).result()
+
+    driver = Driver(call, args.concurrency, args.rate, args.requests,
+                    args.duration)
+    elapsed = driver.run()
+    report = summarize(driver.latencies, driver.errors, 1, elapsed)
+
+    # the forward pass alone, on already preprocessed inputs
+    import numpy as np
+    from preprocess import fill_batch
+
+    model = inference.registry.get()
+    buffer = np.empty((args.batch_size, 3, 32, 32), dtype=np.float32)
+    batch = fill_batch([inputs[i % len(inputs)]
+                        for i in range(args.batch_size)], buffer)
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        model(batch)
+    forward_ms = 1000.0 * (time.perf_counter() - started) / args.repeat
+
+    report.update({
+        "model_load_s": load_s,
+        "backend": inference.registry.backend,
+        "preprocess_ms": preprocess_ms,
+        "forward_ms": {"batch_size": args.batch_size,
+                       "per_batch": forward_ms,
+                       "per_image": forward_ms / args.batch_size},
+    })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the inference container")
+    parser.add_argument("mode", choices=["http", "inprocess"])
+    parser.add_argument("--images",
+                        help="image directory (default: synthetic corpus)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float,
+                        help="requests per second (open loop)")
+    parser.add_argument("--requests", type=int, help="stop after N requests")
+    parser.add_argument("--duration", type=float,
+                        help="stop after N seconds (default 10)")
+    parser.add_argument("--output", help="also write the report here")
+
+    parser.add_argument("--url", help="benchmark a running server instead")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--server", default="production",
+                        choices=["production", "development"])
+    parser.add_argument("--content-type", default="raw",
+                        choices=["raw", "json", "multipart"])
+    parser.add_argument("--batch", type=int, default=1,
+                        help="images per request (json/multipart)")
+    parser.add_argument("--ready-timeout", type=float, default=120)
+
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="in-process: repetitions per timing")
+    parser.add_argument("--batch-size", type=int, default=32,
+                        help="in-process: batch size for the forward timing")
+    args = parser.parse_args()
+
+    if args.content_type == "raw" and args.batch != 1:
+        parser.error("--content-type raw sends one image per request")
+
+    corpus = load_corpus(args.images) if args.images else synthetic_corpus()
+
+    if args.mode == "http":
+        report = run_http(args, corpus)
+    else:
+        report = run_inprocess(args, corpus)
+
+    report["config"] = {key: value for key, value in vars(args).items()}
+    report["corpus_size"] = len(corpus)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as outfile:
+            outfile.write(text + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import torch
+from model import CNN
+
+BACKENDS = ("eager", "torchscript", "onnx", "int8-dynamic", "int8-static")
+
+ARTIFACT_SUFFIXES = {
+    "torchscript": ".torchscript.pt",
+    "onnx": ".onnx",
+    "int8-dynamic": ".int8-dynamic.pt",
+    "int8-static": ".int8-static.pt",
+}
+
+
+def artifact_path(state_dict_path, backend):
+    """
+    Where the exported artifact for a backend lives: next to the state
+    dict, e.g. model_state_dict.pt -> model_state_dict.onnx.
+    """
+    if backend == "eager":
+        return state_dict_path
+    base, ext = os.path.splitext(state_dict_path)
+    return base + ARTIFACT_SUFFIXES[backend]
+
+
+def load_eager_model(state_dict_path, mmap=False):
+    """
+    Builds an eval-mode CNN from a state dict.
+
+    With mmap=True the weight file is memory-mapped and the parameters
+    are assigned straight onto the mapped storage instead of being
+    copied. The pages are never written, so every worker process that
+    maps the same file shares one copy of the weights in the page
+    cache.
+    """
+    if not mmap:
+        model = CNN()
+        model.load_state_dict(torch.load(state_dict_path,
+                                         map_location=torch.device('cpu')))
+        model.eval()
+        return model
+
+    # build on the meta device so no throwaway weights are allocated
+    with torch.device("meta"):
+        model = CNN()
+    state_dict = torch.load(state_dict_path, mmap=True,
+                            map_location=torch.device('cpu'))
+    model.load_state_dict(state_dict, assign=True)
+    model.eval()
+    return model
+
+
+class TorchEngine:
+    """
+    Runs an eager or TorchScript module. Takes a float32 NCHW numpy
+    batch and returns a 1-d array of probabilities.
+    """
+
+    def __init__(self, module, backend):
+        self.module = module
+        self.backend = backend
+
+    def __call__(self, batch):
+        with torch.inference_mode():
+            logits = self.module(torch.from_numpy(batch))
+            return torch.sigmoid(logits).view(-1).numpy()
+
+
+class OnnxEngine:
+    """
+    Runs the exported ONNX graph through ONNX Runtime on the CPU.
+    """
+
+    backend = "onnx"
+
+    def __init__(self, path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError("the onnx backend requires onnxruntime")
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.graph_optimization_level = \
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        logits = self.session.run(None, {self.input_name: batch})[0]
+        return (1.0 / (1.0 + np.exp(-logits))).reshape(-1)
+
+
+def load_engine(state_dict_path, backend="eager", mmap=False):
+    """
+    Loads the engine for a backend. mmap only applies to eager mode;
+    the other backends load their own exported artifact, and each
+    process keeps a private copy of it.
+    """
+    if backend not in BACKENDS:
+        raise ValueError("unknown inference backend: " + backend)
+
+    if backend == "eager":
+        return TorchEngine(load_eager_model(state_dict_path, mmap), backend)
+
+    path = artifact_path(state_dict_path, backend)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            path + " not found, run export_model.py to create it")
+
+    if backend == "onnx":
+        return OnnxEngine(path)
+
+    # torchscript and both int8 variants are saved as frozen TorchScript
+    module = torch.jit.load(path, map_location=torch.device('cpu'))
+    module.eval()
+    return TorchEngine(module, backend)
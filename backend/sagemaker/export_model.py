@@ -0,0 +1,116 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+
+from engines import artifact_path, load_eager_model
+from preprocess import fill_batch, preprocess
+
+
+def load_reference_batch(image_dir):
+    """
+    Preprocesses every readable image in image_dir into one float32
+    NCHW batch, the same way the server does.
+    """
+    names = sorted(os.listdir(image_dir))
+    model_inputs = []
+    for name in names:
+        path = os.path.join(image_dir, name)
+        if not os.path.isfile(path):
+            continue
+        try:
+            with open(path, "rb") as infile:
+                model_inputs.append(preprocess(infile.read()))
+        except Exception as e:
+            print("skipping", path + ":", e, file=sys.stderr)
+
+    if not model_inputs:
+        raise ValueError("no readable images in " + image_dir)
+
+    out = np.empty((len(model_inputs), 3, 32, 32), dtype=np.float32)
+    return fill_batch(model_inputs, out)
+
+
+def freeze(model, example):
+    traced = torch.jit.trace(model, example)
+    return torch.jit.freeze(traced)
+
+
+def export_torchscript(model, example, path):
+    torch.jit.save(freeze(model, example), path)
+
+
+def export_onnx(model, example, path):
+    torch.onnx.export(model, example, path,
+                      input_names=["input"],
+                      output_names=["logit"],
+                      dynamic_axes={"input": {0: "batch"},
+                                    "logit": {0: "batch"}},
+                      opset_version=17)
+
+
+def export_int8_dynamic(model, example, path):
+    # fc1 holds ~4.2M of the weights; dynamic int8 targets the Linears
+    quantized = torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8)
+    torch.jit.save(freeze(quantized, example), path)
+
+
+def export_int8_static(model, example, path, calibration):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = "fbgemm"
+    qconfig_mapping = get_default_qconfig_mapping("fbgemm")
+    prepared = prepare_fx(model, qconfig_mapping, (example,))
+
+    with torch.no_grad():
+        for start in range(0, len(calibration), 64):
+            prepared(torch.from_numpy(calibration[start:start + 64]))
+
+    quantized = convert_fx(prepared)
+    torch.jit.save(freeze(quantized, example), path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export inference artifacts next to the state dict")
+    parser.add_argument("--model", default="./model_state_dict.pt")
+    parser.add_argument("--backends", nargs="+",
+                        default=["torchscript", "onnx", "int8-dynamic",
+                                 "int8-static"])
+    parser.add_argument("--calibration",
+                        help="image directory for int8-static calibration")
+    args = parser.parse_args()
+
+    example = torch.zeros(1, 3, 32, 32)
+
+    for backend in args.backends:
+        # each export gets a fresh model, quantization mutates in place
+        model = load_eager_model(args.model)
+        path = artifact_path(args.model, backend)
+
+        if backend == "torchscript":
+            export_torchscript(model, example, path)
+        elif backend == "onnx":
+            export_onnx(model, example, path)
+        elif backend == "int8-dynamic":
+            export_int8_dynamic(model, example, path)
+        elif backend == "int8-static":
+            if not args.calibration:
+                print("skipping int8-static: --calibration is required",
+                      file=sys.stderr)
+                continue
+            export_int8_static(model, example, path,
+                               load_reference_batch(args.calibration))
+        else:
+            print("skipping unknown backend:", backend, file=sys.stderr)
+            continue
+
+        print("wrote", path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Gunicorn settings for the production inference server (see serve.py).
+#
+# Every setting can be overridden from the environment:
+#   SERVER_WORKERS    worker processes (default: one per available core)
+#   SERVER_THREADS    request threads per worker, so the micro-batcher
+#                     sees concurrent requests (default 8)
+#   TORCH_THREADS     intra-op threads per worker (default: cores/workers)
+#   PIN_WORKERS       1 to pin each worker to its own slice of cores
+#   GRACEFUL_TIMEOUT  seconds a worker gets to finish in-flight requests
+#   SERVER_SHARED_DIR scratch directory the workers share, emptied at
+#                     startup; POST /models swaps are passed to every
+#                     worker and /metrics merges all workers' metrics
+#                     through it (default /tmp/inference)
+#
+# Weights are memory-mapped by default (WEIGHTS_MMAP=1, eager backend), so
+# all workers share one copy; each worker logs its RSS/PSS once loaded.
+
+import os
+import shutil
+
+CPUS = sorted(os.sched_getaffinity(0))
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "8080")
+workers = int(os.environ.get("SERVER_WORKERS", len(CPUS)))
+worker_class = "gthread"
+threads = int(os.environ.get("SERVER_THREADS", 8))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+timeout = 60
+keepalive = 75
+
+torch_threads = int(os.environ.get("TORCH_THREADS",
+                                   max(1, len(CPUS) // workers)))
+# applied by inference.load_models(), so that torch is still imported
+# (and timed) there rather than here before /ping can answer
+os.environ["TORCH_THREADS"] = str(torch_threads)
+os.environ.setdefault("TORCH_INTEROP_THREADS", "1")
+pin_workers = os.environ.get("PIN_WORKERS", "0") == "1"
+
+# set here in the master, so every worker inherits it
+shared_dir = os.environ.setdefault("SERVER_SHARED_DIR", "/tmp/inference")
+
+
+def on_starting(server):
+    # nothing from a previous run of the server applies to this one
+    shutil.rmtree(shared_dir, ignore_errors=True)
+    os.makedirs(shared_dir)
+
+
+def pre_fork(server, worker):
+    # give each worker the lowest core slice no live worker is using,
+    # so a respawned worker takes over the slice of the one it replaces
+    used = {getattr(w, "slot", None) for w in server.WORKERS.values()}
+    worker.slot = min(set(range(len(server.WORKERS) + 1)) - used)
+
+
+def post_fork(server, worker):
+    # each worker's torch threads get cores of their own
+    if pin_workers:
+        start = (worker.slot * torch_threads) % len(CPUS)
+        cores = {CPUS[(start + i) % len(CPUS)] for i in range(torch_threads)}
+        os.sched_setaffinity(0, cores)
+        server.log.info("worker %s (slot %s) pinned to cores %s",
+                        worker.pid, worker.slot, sorted(cores))
+
+
+def post_worker_init(worker):
+    import inference
+    inference.start()
+
+
+def worker_exit(server, worker):
+    import inference
+    inference.stop()
@@ -1,68 +1,373 @@
-import torch
-from PIL import Image
-import numpy as np
-from model import CNN
-import flask
-from flask import Flask, request, jsonify
+from startup import StartupProfile
+
+profile = StartupProfile()
+
+with profile.phase("import_flask"):
+    import flask
+    from flask import Flask, request, jsonify
 import base64
-import io
+import os
+import threading
+import time
+
+import metrics
+from memstats import log_memory_report, memory_report
 
 app = flask.Flask(__name__)
 
+# torch, numpy and PIL are only needed once a model is loaded, so they
+# are imported by load_models() in the background and /ping can answer
+# as soon as flask is up. These are set, registry last, when it is done.
+registry = None
+batcher = None
+preprocess = None
+model_registry = None
+swap_file = None
+
+
+def not_ready():
+    return jsonify({'error': 'model is still loading'}), 503
+
 
 @app.route('/ping', methods=["GET", "POST"])
 def ping():
+    # only healthy once every model_version is loaded and warmed up
+    if registry is None or not registry.is_ready():
+        return '', 503
     return '', 200
 
 
+@app.route('/metrics', methods=["GET"])
+def metrics_report():
+    return app.response_class(metrics.render(),
+                              mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/startup', methods=["GET"])
+def startup_report():
+    return jsonify(profile.report()), 200
+
+
+@app.route('/models', methods=["GET"])
+def list_models():
+    if registry is None:
+        return not_ready()
+
+    return jsonify({"default_model_version": registry.default_version,
+                    "backend": registry.backend,
+                    "weights_mmap": registry.mmap,
+                    "memory": memory_report(),
+                    "model_versions": registry.versions()}), 200
+
+
+@app.route('/models', methods=["POST"])
+def swap_model():
+    if registry is None:
+        return not_ready()
+
+    data = request.get_json()
+
+    if data is None or "model_version" not in data or "path" not in data:
+        return jsonify({'error': 'model_version and path are required'}), 400
+
+    version = str(data["model_version"])
+    try:
+        path = model_registry.resolve_model_path(str(data["path"]))
+        # builds and warms the new weights before swapping them in
+        registry.load(version, path)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    # the other gunicorn workers pick the swap up from the shared
+    # file within a second or two (see model_registry.watch_swaps)
+    if swap_file is not None:
+        swap_file.record(version, path)
+
+    return jsonify({"model_versions": registry.versions()}), 200
+
+
+IMAGE_CONTENT_TYPES = ("application/x-image", "image/jpeg", "image/png")
+
+# already preprocessed (3, 32, 32) uint8 model inputs, see
+# preprocess.to_npy; nothing is decoded or resized for these
+NPY_CONTENT_TYPE = "application/x-npy"
+
+
 @app.route('/invocations', methods=["POST"])
 def invoke():
-    data = request.get_json()
+    started = time.perf_counter()
+    metrics.IN_FLIGHT.inc()
+    try:
+        response, status = handle_invocation()
+    finally:
+        metrics.IN_FLIGHT.dec()
+
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started)
+    metrics.REQUESTS.inc(status=status)
+    return response, status
+
+
+def handle_invocation():
+    if registry is None:
+        return not_ready()
+
+    content_type = request.mimetype
+
+    if content_type in IMAGE_CONTENT_TYPES:
+        # one raw image as the whole body, no base64 or JSON
+        return invoke_one(request.get_data(), query_model_version())
+
+    if content_type == NPY_CONTENT_TYPE:
+        # one model input, or a (N, 3, 32, 32) batch of them
+        try:
+            array = preprocess.from_npy(request.get_data())
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if array.ndim == 3:
+            return score_one(array, query_model_version())
+        return score_many([(model_input, None) for model_input in array],
+                          query_model_version(), query_return_inputs())
+
+    if content_type == "multipart/form-data":
+        # N raw images or application/x-npy model inputs, one per
+        # part, answered in part order
+        parts = [(f.mimetype, f.read()) for _, f in request.files.items(multi=True)]
+        return score_many(load_inputs(parts), query_model_version(),
+                          query_return_inputs())
+
+    data = request.get_json(silent=True)
 
     if data is None:
         return jsonify({'error': 'No JSON data provided'}), 400
 
+    if "images" in data:
+        started = time.perf_counter()
+        try:
+            images = [base64.b64decode(image) for image in data["images"]]
+        except Exception:
+            return jsonify({'error': 'images must be base64 strings'}), 400
+        metrics.STAGE_SECONDS.observe(
+            (time.perf_counter() - started) / max(len(images), 1),
+            stage="base64_decode")
+        return invoke_many(images, data.get("model_version"))
+
+    started = time.perf_counter()
     base64_image = data["image"]
 
     image_bytes = base64.b64decode(base64_image)
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - started,
+                                  stage="base64_decode")
+
+    return invoke_one(image_bytes, data.get("model_version"))
+
+
+def query_attribute(name):
+    """
+    An option for binary bodies: a ?<name>= query argument, or
+    <name>=<value> in SageMaker's CustomAttributes header.
+    """
+    if name in request.args:
+        return request.args[name]
+
+    attributes = request.headers.get("X-Amzn-SageMaker-Custom-Attributes", "")
+    for attribute in attributes.split(","):
+        key, _, value = attribute.strip().partition("=")
+        if key == name and value:
+            return value
+    return None
+
 
-    # Create a BytesIO object from the decoded bytes
-    image_buffer = io.BytesIO(image_bytes)
+def query_model_version():
+    return query_attribute("model_version")
 
-    image = Image.open(image_buffer)
 
-    # model() is a hypothetical function that gets the inference output:
-    prob = predict(image)
+def query_return_inputs():
+    # whether batch responses include each image's model input, so
+    # the caller can store it and skip decoding when re-scoring
+    return query_attribute("return_inputs") in ("1", "true")
 
+
+def preprocess_timed(image_bytes):
+    # decode, resize and to_array timings for this one image
+    timings = {}
+    model_input = preprocess.preprocess(image_bytes, timings)
+    metrics.observe_stages(timings)
+    return model_input
+
+
+def invoke_one(image_bytes, model_version):
+    try:
+        model_input = preprocess_timed(image_bytes)
+    except Exception as e:
+        metrics.IMAGES.inc(outcome="error")
+        return jsonify({'error': str(e)}), 400
+
+    return score_one(model_input, model_version)
+
+
+def score_one(model_input, model_version):
+    try:
+        prob = batcher.submit(model_input, model_version).result()
+    except KeyError:
+        metrics.IMAGES.inc(outcome="error")
+        return jsonify({'error': 'Unknown model_version'}), 400
+    except Exception as e:
+        metrics.IMAGES.inc(outcome="error")
+        return jsonify({'error': str(e)}), 400
+
+    metrics.IMAGES.inc(outcome="scored")
     return jsonify({"probability_real": prob}), 200
 
 
-def predict(image_raw):
+def load_inputs(parts):
+    """
+    Model inputs for a list of (content_type, bytes) parts: encoded
+    images are decoded and resized, application/x-npy parts are used
+    as they are. Returns (model_input, None) or (None, error message)
+    per part.
+    """
+    loaded = []
+    for content_type, data in parts:
+        try:
+            if content_type == NPY_CONTENT_TYPE:
+                model_input = preprocess.from_npy(data)
+                if model_input.ndim != 3:
+                    raise ValueError("expected one (3, 32, 32) model input per part")
+            else:
+                model_input = preprocess_timed(data)
+            loaded.append((model_input, None))
+        except Exception as e:
+            loaded.append((None, str(e)))
+    return loaded
+
+
+def invoke_many(images, model_version):
+    """
+    Scores a list of encoded images. A bad image gets a null
+    probability and an error message at its position rather than
+    failing the whole request.
+    """
+    return score_many(load_inputs([(None, image) for image in images]),
+                      model_version)
+
+
+def score_many(loaded, model_version, return_inputs=False):
+    """
+    Scores a list of (model_input, error) pairs from load_inputs. With
+    return_inputs the response also carries each model input as
+    base64 .npy bytes in "model_inputs" (null where loading failed).
+    """
+    if not loaded:
+        return jsonify({'error': 'No images provided'}), 400
+
+    try:
+        registry.get(model_version)
+    except KeyError:
+        return jsonify({'error': 'Unknown model_version'}), 400
+
+    # submit everything before waiting so the images share batches
+    futures = []
+    errors = []
+    for model_input, error in loaded:
+        if error is not None:
+            futures.append(None)
+            errors.append(error)
+            continue
+        try:
+            futures.append(batcher.submit(model_input, model_version))
+            errors.append(None)
+        except Exception as e:
+            futures.append(None)
+            errors.append(str(e))
+
+    probs = []
+    for i, future in enumerate(futures):
+        if future is None:
+            probs.append(None)
+            continue
+        try:
+            probs.append(future.result())
+        except Exception as e:
+            probs.append(None)
+            errors[i] = str(e)
+
+    failed = sum(1 for error in errors if error is not None)
+    metrics.IMAGES.inc(len(loaded) - failed, outcome="scored")
+    if failed:
+        metrics.IMAGES.inc(failed, outcome="error")
+
+    response = {"probabilities_real": probs, "errors": errors}
+    if return_inputs:
+        response["model_inputs"] = [
+            None if model_input is None else
+            base64.b64encode(preprocess.to_npy(model_input)).decode()
+            for model_input, _ in loaded]
+    return jsonify(response), 200
+
+
+def predict(image_raw, model_version=None):
+    # queued with concurrent requests and run as one forward pass
+    model_input = preprocess.to_model_input(image_raw)
+    return batcher.submit(model_input, model_version).result()
+
+
+def load_models():
+    global registry, batcher, preprocess, model_registry, swap_file
+
+    with profile.phase("import_numpy"):
+        import numpy
+    with profile.phase("import_torch"):
+        import torch
+    # gunicorn.conf.py sizes these so workers don't oversubscribe the cores
+    if "TORCH_THREADS" in os.environ:
+        torch.set_num_threads(int(os.environ["TORCH_THREADS"]))
+    if "TORCH_INTEROP_THREADS" in os.environ:
+        torch.set_num_interop_threads(int(os.environ["TORCH_INTEROP_THREADS"]))
+    with profile.phase("import_pil"):
+        import PIL.Image
+    with profile.phase("import_server_modules"):
+        import batching
+        import model_registry as model_registry_module
+        import preprocess as preprocess_module
+
+    new_registry, model_versions = model_registry_module.registry_from_env()
+    # a respawned worker starts with the swaps made since startup
+    new_swap_file = model_registry_module.swap_file_from_env()
+    if new_swap_file is not None:
+        model_versions.update(new_swap_file.read())
+    with profile.phase("load_and_warm_up_models"):
+        new_registry.load_all(model_versions)
+    if new_swap_file is not None:
+        model_registry_module.watch_swaps(new_registry, new_swap_file)
+
+    preprocess = preprocess_module
+    model_registry = model_registry_module
+    swap_file = new_swap_file
+    batcher = batching.batcher_from_env(new_registry)
+    registry = new_registry
 
-    device = torch.device("cpu")
+    profile.mark_ready()
+    profile.log()
+    for phase, seconds in profile.phases.items():
+        metrics.STARTUP_SECONDS.set(seconds, phase=phase)
+    # per-worker RSS/PSS, to confirm the workers share one weight copy
+    log_memory_report("models_loaded")
 
-    # Open the image using Pillow
-    image_resized = image_raw.resize((32, 32))
 
-    # Convert the image to a NumPy array
-    image = np.array(image_resized)
-    image = torch.tensor(image, dtype=torch.float32) / 255.0
-    image = image.transpose(1, 2).transpose(0, 1).unsqueeze(0)
-    image = image.to(device)
+def start():
+    # load in the background so /ping answers (503) while weights load
+    threading.Thread(target=load_models, daemon=True).start()
+    metrics.share()
 
-    model = CNN()
-    model.load_state_dict(torch.load("./model_state_dict.pt",
-                                     map_location=torch.device('cpu')))
-    model.to(device)
 
-    model.eval()
-    sigmoid = torch.nn.Sigmoid()
-    with torch.no_grad():
-        image = image.to(device)
-        logit = model(image)
-        prob = sigmoid(logit)
-        return prob.item()
+def stop():
+    # let queued images finish before the worker exits
+    if batcher is not None:
+        batcher.stop(timeout=10)
+    metrics.flush()
 
 
 if __name__ == '__main__':
-    app.run(port=8080, debug=True)
+    # development server only, production serving goes through serve.py
+    start()
+    app.run(port=8080, debug=True, use_reloader=False, threaded=True)
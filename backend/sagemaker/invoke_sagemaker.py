@@ -1,31 +1,37 @@
+import sys
 import boto3
 import json
-import base64
+from urllib3 import encode_multipart_formdata
 
 runtime = boto3.client("sagemaker-runtime")
 
 endpoint_name = "artifact-v6"
-content_type = "application/json"
 
-with open("./deploy_test/ai.jpg", 'rb') as image_file:
-    # Encode the binary data as base64
-    base64_encoded_image = base64.b64encode(image_file.read()).decode()
+# usage: python invoke_sagemaker.py [image ...]
+image_paths = sys.argv[1:] or ["./deploy_test/ai.jpg"]
 
-# Define the input data as a dictionary
-input_data = {
-    "image": base64_encoded_image
-}
+images = []
+for path in image_paths:
+    with open(path, 'rb') as image_file:
+        images.append(image_file.read())
 
-# Convert the input data to JSON
-input_json = json.dumps(input_data)
+if len(images) == 1:
+    # a single image is sent as the raw request body
+    content_type = "application/x-image"
+    body = images[0]
+else:
+    # several images go in one multipart call, scored in order
+    fields = [("image", (path, image, "application/x-image"))
+              for path, image in zip(image_paths, images)]
+    body, content_type = encode_multipart_formdata(fields)
 
 try:
     print('invoking')
     # Invoke the SageMaker endpoint
     response = runtime.invoke_endpoint(
         EndpointName=endpoint_name,
-        ContentType='application/json',
-        Body=input_json
+        ContentType=content_type,
+        Body=body
     )
     print('invoked')
 
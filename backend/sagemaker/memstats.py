@@ -0,0 +1,39 @@
+import json
+import os
+import sys
+
+
+def memory_report():
+    """
+    Returns this process's memory use in MB, read from /proc. RSS
+    counts shared pages in full; PSS splits them between the processes
+    that map them, so summing pss_mb over workers approximates the
+    real footprint. Returns just the pid where /proc is unavailable.
+    """
+    report = {"pid": os.getpid()}
+    try:
+        with open("/proc/self/smaps_rollup") as infile:
+            for line in infile:
+                fields = line.split()
+                if len(fields) < 2 or not fields[1].isdigit():
+                    continue
+                kb = int(fields[1])
+                key = fields[0].rstrip(":")
+                if key == "Rss":
+                    report["rss_mb"] = kb / 1024.0
+                elif key == "Pss":
+                    report["pss_mb"] = kb / 1024.0
+                elif key in ("Shared_Clean", "Shared_Dirty"):
+                    report["shared_mb"] = report.get("shared_mb", 0.0) + \
+                        kb / 1024.0
+                elif key in ("Private_Clean", "Private_Dirty"):
+                    report["private_mb"] = report.get("private_mb", 0.0) + \
+                        kb / 1024.0
+    except OSError:
+        pass
+    return report
+
+
+def log_memory_report(event):
+    print(json.dumps(dict(memory_report(), event=event)),
+          file=sys.stderr, flush=True)
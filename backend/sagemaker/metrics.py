@@ -0,0 +1,330 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+# Latency and batch-size metrics for the inference server, served on
+# /metrics in the Prometheus text format. Recording is a lock and a few
+# integer adds; quantiles and text are only built when /metrics is
+# scraped.
+#
+# Under gunicorn any worker may answer a scrape, so every worker writes
+# a snapshot of its metrics to SERVER_SHARED_DIR/metrics about once a
+# second and /metrics merges all of them: counters and histograms are
+# summed over every worker that ever ran (so they never go backwards
+# when one is respawned), and quantiles are estimated from the summed
+# buckets. Gauges only count live workers; those that differ per
+# worker (model load and startup times) keep a pid label.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (key, value)
+                          for key, value in sorted(labels.items())) + "}"
+
+
+class Counter:
+    live_only = False
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, snapshots):
+        # summed over the worker processes
+        merged = {}
+        for pid, values in snapshots:
+            for key, value in values.items():
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self, values):
+        lines = ["# HELP %s %s" % (self.name, self.help_text),
+                 "# TYPE %s counter" % self.name]
+        for key, value in sorted(values.items()):
+            lines.append("%s%s %s" % (self.name, format_labels(dict(key)), value))
+        return lines
+
+
+class Gauge:
+    live_only = True
+
+    def __init__(self, name, help_text, per_worker=False):
+        self.name = name
+        self.help_text = help_text
+        # kept apart per worker (pid label) instead of summed
+        self.per_worker = per_worker
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, snapshots):
+        merged = {}
+        for pid, values in snapshots:
+            for key, value in values.items():
+                if self.per_worker:
+                    merged[tuple(sorted(key + (("pid", pid),)))] = value
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self, values):
+        lines = ["# HELP %s %s" % (self.name, self.help_text),
+                 "# TYPE %s gauge" % self.name]
+        for key, value in sorted(values.items()):
+            lines.append("%s%s %s" % (self.name, format_labels(dict(key)), value))
+        return lines
+
+
+class Histogram:
+    """
+    A fixed-bucket histogram. Besides the usual _bucket/_sum/_count
+    series it renders a <name>_quantile gauge with p50/p95/p99
+    estimated by interpolating within the buckets.
+    """
+
+    live_only = False
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # per-bucket counts (last slot is +Inf), sum
+                series = self._series[key] = [[0] * (len(self.buckets) + 1),
+                                              0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def quantile(self, counts, q):
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def snapshot(self):
+        with self._lock:
+            return {key: (list(series[0]), series[1])
+                    for key, series in self._series.items()}
+
+    def merge(self, snapshots):
+        # bucket counts and sums added up over the worker processes
+        merged = {}
+        for pid, series in snapshots:
+            for key, (counts, total) in series.items():
+                if key not in merged:
+                    merged[key] = ([0] * len(counts), 0.0)
+                merged_counts, merged_total = merged[key]
+                merged[key] = ([a + b for a, b in zip(merged_counts, counts)],
+                               merged_total + total)
+        return merged
+
+    def render(self, values):
+        lines = ["# HELP %s %s" % (self.name, self.help_text),
+                 "# TYPE %s histogram" % self.name]
+
+        quantile_lines = []
+        for key, (counts, total) in sorted(values.items()):
+            labels = dict(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("%s_bucket%s %s" % (
+                    self.name, format_labels(dict(labels, le=bound)),
+                    cumulative))
+            lines.append("%s_sum%s %s" % (self.name, format_labels(labels),
+                                          total))
+            lines.append("%s_count%s %s" % (self.name, format_labels(labels),
+                                            cumulative))
+            for q in QUANTILES:
+                quantile_lines.append("%s_quantile%s %s" % (
+                    self.name, format_labels(dict(labels, quantile=q)),
+                    self.quantile(counts, q)))
+
+        if quantile_lines:
+            lines.append("# TYPE %s_quantile gauge" % self.name)
+            lines.extend(quantile_lines)
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "inference_request_duration_seconds",
+    "Time to answer an /invocations request")
+STAGE_SECONDS = Histogram(
+    "inference_stage_duration_seconds",
+    "Time spent in each stage of an invocation; decode stages are per "
+    "image, to_tensor and forward are per batch")
+BATCH_SIZE = Histogram(
+    "inference_batch_size",
+    "Images per forward pass", buckets=BATCH_SIZE_BUCKETS)
+REQUESTS = Counter(
+    "inference_requests_total",
+    "Invocations answered, by HTTP status")
+IMAGES = Counter(
+    "inference_images_total",
+    "Images scored, by outcome")
+IN_FLIGHT = Gauge(
+    "inference_requests_in_flight",
+    "Invocations currently being handled")
+MODEL_LOAD_SECONDS = Gauge(
+    "inference_model_load_seconds",
+    "Time the last load (or hot swap) of each model_version took",
+    per_worker=True)
+STARTUP_SECONDS = Gauge(
+    "inference_startup_phase_seconds",
+    "Duration of each startup phase, including model load",
+    per_worker=True)
+
+ALL = (REQUEST_SECONDS, STAGE_SECONDS, BATCH_SIZE, REQUESTS, IMAGES,
+       IN_FLIGHT, MODEL_LOAD_SECONDS, STARTUP_SECONDS)
+
+
+def observe_stages(timings):
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+def shared_dir():
+    # only gunicorn (see gunicorn.conf.py) runs several workers
+    base = os.environ.get("SERVER_SHARED_DIR")
+    return os.path.join(base, "metrics") if base else None
+
+
+def snapshot():
+    return {metric.name: metric.snapshot() for metric in ALL}
+
+
+def write_snapshot(directory):
+    data = {name: [[key, value] for key, value in values.items()]
+            for name, values in snapshot().items()}
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "%d.json" % os.getpid())
+    with open(path + ".tmp", "w") as outfile:
+        json.dump(data, outfile)
+    os.replace(path + ".tmp", path)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_snapshots(directory):
+    """
+    (pid, alive, snapshot) for every worker that wrote one.
+    """
+    snapshots = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(".json"):
+            continue
+        pid = int(filename[:-len(".json")])
+        try:
+            with open(os.path.join(directory, filename)) as infile:
+                data = json.load(infile)
+        except (OSError, ValueError):
+            continue
+        data = {name: {tuple(tuple(label) for label in key): value
+                       for key, value in values}
+                for name, values in data.items()}
+        snapshots.append((pid, pid_alive(pid), data))
+    return snapshots
+
+
+def share(interval=1.0):
+    """
+    Keeps this worker's snapshot in the shared directory fresh, so
+    whichever worker answers /metrics reports all of them.
+    """
+    directory = shared_dir()
+    if directory is None:
+        return
+
+    def run():
+        while True:
+            try:
+                write_snapshot(directory)
+            except OSError:
+                pass
+            time.sleep(interval)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def flush():
+    # the final counts of a worker that is exiting
+    directory = shared_dir()
+    if directory is not None:
+        write_snapshot(directory)
+
+
+def render():
+    directory = shared_dir()
+    if directory is None:
+        snapshots = [(os.getpid(), True, snapshot())]
+    else:
+        write_snapshot(directory)
+        snapshots = read_snapshots(directory)
+
+    lines = []
+    for metric in ALL:
+        values = metric.merge([(pid, data.get(metric.name, {}))
+                               for pid, alive, data in snapshots
+                               if alive or not metric.live_only])
+        lines.extend(metric.render(values))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,200 @@
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import metrics
+from engines import load_engine
+
+
+def parse_model_versions(spec):
+    """
+    Parses a MODEL_VERSIONS spec such as
+    "1=./model_state_dict.pt,2=./model_v2.pt" into a
+    {model_version: path} dict.
+    """
+    versions = {}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        version, sep, path = entry.partition("=")
+        if not sep or not version.strip() or not path.strip():
+            raise ValueError("bad MODEL_VERSIONS entry: " + entry)
+        versions[version.strip()] = path.strip()
+    return versions
+
+
+class ModelRegistry:
+    """
+    Keeps one loaded inference engine per model_version for the
+    lifetime of the process, all on the same backend (eager,
+    torchscript, onnx, int8-dynamic or int8-static). Models are
+    built, loaded and warmed up off to the side and only then swapped
+    in, so a hot swap never exposes a half-loaded model to in-flight
+    requests.
+    """
+
+    def __init__(self, default_version, backend="eager", mmap=False):
+        self.default_version = default_version
+        self.backend = backend
+        self.mmap = mmap
+        self._models = {}
+        self._paths = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def load(self, version, path):
+        started = time.perf_counter()
+        model = load_engine(path, self.backend, self.mmap)
+        self.warm_up(model)
+        metrics.MODEL_LOAD_SECONDS.set(time.perf_counter() - started,
+                                       model_version=version)
+
+        with self._lock:
+            self._models[version] = model
+            self._paths[version] = path
+
+    def load_all(self, versions):
+        for version, path in versions.items():
+            self.load(version, path)
+
+        if self.default_version not in self._models:
+            raise KeyError("default model_version not loaded: " +
+                           self.default_version)
+        self._ready.set()
+
+    def warm_up(self, model):
+        model(np.zeros((1, 3, 32, 32), dtype=np.float32))
+
+    def get(self, version=None):
+        if version is None:
+            version = self.default_version
+        with self._lock:
+            return self._models[str(version)]
+
+    def versions(self):
+        with self._lock:
+            return sorted(self._models)
+
+    def path(self, version):
+        with self._lock:
+            return self._paths.get(version)
+
+    def is_ready(self):
+        return self._ready.is_set()
+
+
+def model_dir():
+    return os.path.realpath(os.environ.get(
+        "MODEL_DIR", os.path.dirname(os.path.abspath(__file__))))
+
+
+def resolve_model_path(path):
+    """
+    The real path of a state dict for POST /models, which may only
+    load files under MODEL_DIR (the server's own directory by
+    default). Raises ValueError for anything else.
+    """
+    root = model_dir()
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError("path must be inside the model directory")
+    if not os.path.isfile(resolved):
+        raise ValueError("no such model file: " + path)
+    return resolved
+
+
+class SwapFile:
+    """
+    The hot swaps made on any worker of one server, as a
+    {model_version: path} JSON file in the directory the workers
+    share. Every worker watches it and loads what it doesn't have
+    yet, and a respawned worker starts from it, so all workers answer
+    a model_version with the same weights.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        try:
+            with open(self.path) as infile:
+                return json.load(infile)
+        except FileNotFoundError:
+            return {}
+
+    def mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def record(self, version, path):
+        # serialized across workers, replaced atomically for readers
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            swaps = self.read()
+            swaps[version] = path
+            tmp = "%s.%d" % (self.path, os.getpid())
+            with open(tmp, "w") as outfile:
+                json.dump(swaps, outfile)
+            os.replace(tmp, self.path)
+
+
+def swap_file_from_env():
+    # only gunicorn (see gunicorn.conf.py) runs several workers
+    shared_dir = os.environ.get("SERVER_SHARED_DIR")
+    if not shared_dir:
+        return None
+    return SwapFile(os.path.join(shared_dir, "model_versions.json"))
+
+
+def watch_swaps(registry, swap_file, interval=1.0):
+    """
+    Loads every swap another worker records, checking the file's
+    modification time every interval seconds.
+    """
+
+    def run():
+        seen = None
+        while True:
+            time.sleep(interval)
+            mtime = swap_file.mtime()
+            if mtime == seen:
+                continue
+            seen = mtime
+            for version, path in swap_file.read().items():
+                if registry.path(version) == path:
+                    continue
+                try:
+                    registry.load(version, path)
+                except Exception as e:
+                    print(json.dumps({"event": "model_swap_failed",
+                                      "pid": os.getpid(),
+                                      "model_version": version,
+                                      "error": str(e)}),
+                          file=sys.stderr, flush=True)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def registry_from_env():
+    default_path = "./model_state_dict.pt"
+    default_version = os.environ.get("DEFAULT_MODEL_VERSION", "1")
+    spec = os.environ.get("MODEL_VERSIONS",
+                          default_version + "=" + default_path)
+
+    # fast-startup mode defaults to the pre-serialized TorchScript
+    # artifact, which loads without building the CNN in Python
+    fast_startup = os.environ.get("FAST_STARTUP", "0") == "1"
+    backend = os.environ.get("INFERENCE_BACKEND",
+                             "torchscript" if fast_startup else "eager")
+    mmap = os.environ.get("WEIGHTS_MMAP", "1") == "1"
+
+    registry = ModelRegistry(default_version, backend, mmap)
+    return registry, parse_model_versions(spec)
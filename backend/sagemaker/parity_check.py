@@ -0,0 +1,58 @@
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from engines import BACKENDS, load_engine
+from export_model import load_reference_batch
+
+
+def check(model_path, image_dir, backends, tolerance):
+    """
+    Scores the reference images with eager mode and with each backend
+    and reports the largest absolute probability difference.
+    """
+    batch = load_reference_batch(image_dir)
+    reference = load_engine(model_path, "eager")(batch)
+
+    report = {}
+    for backend in backends:
+        if backend == "eager":
+            continue
+        try:
+            probs = load_engine(model_path, backend)(batch)
+        except Exception as e:
+            report[backend] = {"ok": False, "error": str(e)}
+            continue
+
+        drift = np.abs(np.asarray(probs) - reference)
+        report[backend] = {
+            "ok": bool(drift.max() <= tolerance),
+            "max_abs_diff": float(drift.max()),
+            "mean_abs_diff": float(drift.mean()),
+        }
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fail if a backend drifts from eager mode")
+    parser.add_argument("images", help="reference image directory")
+    parser.add_argument("--model", default="./model_state_dict.pt")
+    parser.add_argument("--backends", nargs="+",
+                        default=[b for b in BACKENDS if b != "eager"])
+    parser.add_argument("--tolerance", type=float, default=0.02,
+                        help="max allowed absolute probability difference")
+    args = parser.parse_args()
+
+    report = check(args.model, args.images, args.backends, args.tolerance)
+    print(json.dumps(report, indent=2))
+
+    if not all(result["ok"] for result in report.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
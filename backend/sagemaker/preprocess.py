@@ -0,0 +1,186 @@
+import io
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+INPUT_SIZE = (32, 32)
+
+
+class StageTimer:
+    """
+    Accumulates wall-clock seconds per named stage into a dict, e.g.
+    {"decode": 0.004, "resize": 0.0002}. A timer built with None
+    records nothing.
+    """
+
+    def __init__(self, timings=None):
+        self.timings = timings
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        if self.timings is not None:
+            self.timings[stage] = self.timings.get(stage, 0.0) + \
+                (now - self._last)
+        self._last = now
+
+
+def to_rgb(image):
+    """
+    Converts any PIL mode to 3-channel RGB. Alpha is dropped rather
+    than composited, and palette images with transparency go through
+    RGBA so PIL doesn't warn about it.
+    """
+    if image.mode == "RGB":
+        return image
+    if image.mode == "P" and "transparency" in image.info:
+        image = image.convert("RGBA")
+    return image.convert("RGB")
+
+
+def decode(image_bytes, timings=None):
+    """
+    Decodes encoded image bytes to a 32x32 RGB PIL image.
+
+    JPEGs are decoded with draft(), which lets libjpeg scale by 1/2,
+    1/4 or 1/8 during decoding, so a 12 MP photo is decoded at roughly
+    the smallest scale that is still at least 32x32 instead of at full
+    size.
+    """
+    timer = StageTimer(timings)
+
+    image = Image.open(io.BytesIO(image_bytes))
+    if image.format == "JPEG":
+        image.draft("RGB", INPUT_SIZE)
+    image = to_rgb(image)
+    image.load()
+    timer.lap("decode")
+
+    image = image.resize(INPUT_SIZE, Image.BICUBIC)
+    timer.lap("resize")
+
+    return image
+
+
+def to_model_input(image):
+    """
+    Returns the canonical model input for a PIL image: a (3, 32, 32)
+    uint8 array in CHW order.
+    """
+    image = to_rgb(image)
+    if image.size != INPUT_SIZE:
+        image = image.resize(INPUT_SIZE, Image.BICUBIC)
+    return np.ascontiguousarray(np.asarray(image, dtype=np.uint8)
+                                .transpose(2, 0, 1))
+
+
+def preprocess(image_bytes, timings=None):
+    image = decode(image_bytes, timings)
+
+    timer = StageTimer(timings)
+    model_input = to_model_input(image)
+    timer.lap("to_array")
+
+    return model_input
+
+
+def to_npy(model_input):
+    """
+    Serializes model inputs as .npy bytes: about 3 KB per (3, 32, 32)
+    input. This is the form stored under modelInputs/ in S3 and sent
+    as application/x-npy.
+    """
+    out = io.BytesIO()
+    np.save(out, model_input, allow_pickle=False)
+    return out.getvalue()
+
+
+def from_npy(data):
+    """
+    Loads .npy bytes holding one (3, 32, 32) uint8 model input or a
+    (N, 3, 32, 32) batch of them. Raises ValueError for anything else.
+    """
+    try:
+        array = np.load(io.BytesIO(data), allow_pickle=False)
+    except Exception as e:
+        raise ValueError("not a .npy array: " + str(e))
+
+    if array.dtype != np.uint8 or array.ndim not in (3, 4) or \
+            tuple(array.shape[-3:]) != (3,) + INPUT_SIZE:
+        raise ValueError("expected uint8 model inputs of shape (3, 32, 32) "
+                         "or (N, 3, 32, 32), got %s %s" % (array.dtype, array.shape))
+    return array
+
+
+def fill_batch(model_inputs, out):
+    """
+    Copies (3, 32, 32) uint8 model inputs into the preallocated
+    float32 NCHW buffer out and scales them to [0, 1] in place.
+    Returns the filled out[:n] view.
+    """
+    batch = out[:len(model_inputs)]
+    for i, model_input in enumerate(model_inputs):
+        np.copyto(batch[i], model_input, casting="unsafe")
+    np.divide(batch, 255.0, out=batch)
+    return batch
+
+
+def legacy_preprocess(image_bytes, timings=None):
+    """
+    The pre-pipeline path (full decode, resize, tensor, two
+    transposes), kept only so __main__ can compare against it.
+    """
+    import torch
+
+    timer = StageTimer(timings)
+
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    timer.lap("decode")
+
+    image_resized = image.resize(INPUT_SIZE)
+    timer.lap("resize")
+
+    image = np.array(image_resized)
+    image = torch.tensor(image, dtype=torch.float32) / 255.0
+    image = image.transpose(1, 2).transpose(0, 1).unsqueeze(0)
+    timer.lap("to_array")
+
+    return image
+
+
+def compare(paths, repeat=5):
+    """
+    Runs both pipelines over the given files and returns mean
+    milliseconds per image for each stage.
+    """
+    images = []
+    for path in paths:
+        with open(path, "rb") as infile:
+            images.append(infile.read())
+
+    report = {}
+    for name, fn in (("legacy", legacy_preprocess), ("fast", preprocess)):
+        timings = {}
+        count = 0
+        for _ in range(repeat):
+            for image_bytes in images:
+                try:
+                    fn(image_bytes, timings)
+                    count += 1
+                except Exception as e:
+                    print(name, "failed:", e, file=sys.stderr)
+        report[name] = {stage: 1000.0 * total / max(count, 1)
+                        for stage, total in timings.items()}
+        report[name]["total"] = sum(report[name].values())
+
+    return report
+
+
+if __name__ == '__main__':
+    # usage: python preprocess.py image [image ...]
+    import json
+
+    print(json.dumps(compare(sys.argv[1:]), indent=2))
@@ -0,0 +1,24 @@
+import os
+import sys
+
+# SageMaker starts the container as "<entrypoint> serve", so any
+# arguments are ignored and the mode comes from SERVER_MODE instead.
+
+
+def main():
+    if os.environ.get("SERVER_MODE", "production") == "development":
+        import inference
+        inference.start()
+        inference.app.run(host="0.0.0.0",
+                          port=int(os.environ.get("PORT", 8080)), debug=True,
+                          use_reloader=False, threaded=True)
+        return
+
+    from gunicorn.app.wsgiapp import run
+
+    sys.argv = ["gunicorn", "--config", "gunicorn.conf.py", "inference:app"]
+    run()
+
+
+if __name__ == '__main__':
+    main()
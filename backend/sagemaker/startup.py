@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+def process_age():
+    """
+    Seconds since this process was exec'd, from /proc, so the report
+    also covers interpreter startup before any of our code ran.
+    Returns None where /proc is unavailable.
+    """
+    try:
+        with open("/proc/self/stat") as infile:
+            # the command name may contain spaces, fields start after ')'
+            fields = infile.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as infile:
+            uptime = float(infile.read().split()[0])
+        start_ticks = int(fields[19])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupProfile:
+    """
+    Records how long each startup phase takes (imports, model load,
+    warm-up) so cold-start time can be tracked per release.
+    """
+
+    def __init__(self):
+        self.created = time.perf_counter()
+        self.interpreter_s = process_age()
+        self.phases = {}
+        self.ready_s = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def mark_ready(self):
+        self.ready_s = time.perf_counter() - self.created
+
+    def report(self):
+        total = None
+        if self.ready_s is not None:
+            total = self.ready_s + (self.interpreter_s or 0.0)
+        return {
+            "release": os.environ.get("RELEASE"),
+            "pid": os.getpid(),
+            "interpreter_s": self.interpreter_s,
+            "phases_s": dict(self.phases),
+            "ready_after_s": self.ready_s,
+            "cold_start_s": total,
+        }
+
+    def log(self):
+        print(json.dumps(dict(self.report(), event="startup")),
+              file=sys.stderr, flush=True)
@@ -0,0 +1,146 @@
+#
+# Shared status checks for retrieve's long-poll wait mode.
+#
+# Waiters register the image ids they are waiting on; one background
+# thread per execution environment checks the status of every id
+# currently waited on, and wakes the waiters whose jobs have finished.
+#
+# A lambda execution environment serves one request at a time, so
+# sharing within it only covers the ids of one batch request. What is
+# shared across all of them is the shared cache tier (RESULT_CACHE_URL,
+# see resultcache.py): compute and worker.py publish every status they
+# write there, and waiters read those with one MGET per interval, so
+# however many requests are waiting the database isn't asked. The
+# database itself is only checked with exponential backoff, from
+# WAIT_POLL_INTERVAL up to WAIT_MAX_INTERVAL seconds apart, which keeps
+# a 25 second wait at about as many queries as a client polling every
+# few seconds would make, and still finishes waits when nothing
+# publishes statuses.
+#
+# WAIT_POLL_INTERVAL (default 0.5 seconds) and WAIT_MAX_INTERVAL
+# (default 5 seconds) set the intervals.
+#
+
+import os
+import threading
+import time
+
+# statuses a job never leaves
+final_statuses = ('complete', 'error')
+
+
+class StatusWatcher:
+    def __init__(self, check, interval=0.5, shared_check=None, max_interval=5.0):
+        #
+        # check(image_ids) -> {image_id: status} for the ids that exist,
+        # from the database; shared_check(image_ids) -> {image_id:
+        # status} for the ids whose status was published
+        #
+        self.check = check
+        self.shared_check = shared_check
+        self.interval = interval
+        self.max_interval = max_interval
+        self._waiting = {}  # image_id -> number of waiters
+        self._statuses = {}
+        self._changed = threading.Condition()
+        self._thread = None
+
+    def _run(self):
+        checked = set()
+
+        while True:
+            with self._changed:
+                image_ids = list(self._waiting)
+                if not image_ids:
+                    self._thread = None
+                    return
+
+            if not checked.issuperset(image_ids):
+                # new waiters have just read their jobs from the
+                # database, so the next database check is one interval
+                # away and the backoff starts over
+                checked = set(image_ids)
+                delay = self.interval
+                next_check = time.monotonic() + delay
+
+            statuses = None
+            try:
+                if time.monotonic() >= next_check:
+                    found = self.check(image_ids)
+                    # ids the database doesn't have are finished too
+                    statuses = {image_id: found.get(image_id) for image_id in image_ids}
+                    delay = min(delay * 2, self.max_interval)
+                    next_check = time.monotonic() + delay
+                elif self.shared_check is not None:
+                    statuses = self.shared_check(image_ids)
+            except Exception:
+                # a failed check is retried next interval
+                statuses = None
+
+            if statuses:
+                with self._changed:
+                    for image_id, status in statuses.items():
+                        if image_id in self._waiting:
+                            self._statuses[image_id] = status
+                    self._changed.notify_all()
+
+            time.sleep(self.interval)
+
+    def wait(self, image_ids, timeout):
+        """
+        Blocks until every one of image_ids is finished or missing, or
+        timeout seconds have passed, and returns {image_id: status}
+        from the latest check (None for ids that don't exist or
+        weren't checked yet).
+        """
+        image_ids = list(set(image_ids))
+        deadline = time.monotonic() + timeout
+
+        with self._changed:
+            for image_id in image_ids:
+                self._waiting[image_id] = self._waiting.get(image_id, 0) + 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            try:
+                while True:
+                    if all(image_id in self._statuses and
+                           (self._statuses[image_id] is None or
+                            self._statuses[image_id] in final_statuses)
+                           for image_id in image_ids):
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+
+                return {image_id: self._statuses.get(image_id) for image_id in image_ids}
+            finally:
+                for image_id in image_ids:
+                    self._waiting[image_id] -= 1
+                    if not self._waiting[image_id]:
+                        del self._waiting[image_id]
+                        self._statuses.pop(image_id, None)
+
+
+_watcher = None
+_lock = threading.Lock()
+
+
+def watcher(check, shared_check=None):
+    """
+    The execution environment's watcher, created on first use with
+    the given status checks.
+    """
+    global _watcher
+
+    with _lock:
+        if _watcher is None:
+            _watcher = StatusWatcher(
+                check,
+                float(os.environ.get('WAIT_POLL_INTERVAL', '0.5')),
+                shared_check,
+                float(os.environ.get('WAIT_MAX_INTERVAL', '5')))
+        return _watcher
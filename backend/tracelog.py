@@ -0,0 +1,128 @@
+#
+# Structured JSON logging and per-stage timing for the lambdas.
+#
+# Every line is one JSON object carrying the lambda name, the AWS
+# request id and whatever correlation fields were bound (image_id,
+# bucket_key), so one image can be followed from upload through compute
+# to retrieve in CloudWatch Logs Insights. Stage timings (S3 get/put,
+# SageMaker invoke, each SQL statement) are collected by
+#
+#   with tracelog.stage("sql.select_metadata"):
+#     ...
+#
+# and emitted together in one summary line when the invocation ends.
+# Work done concurrently in pool threads is timed once around the whole
+# phase, from the invocation's own thread, since the threads' times
+# overlap and would add up to more than the phase took.
+#
+# Detail lines are sampled at LOG_SAMPLE_RATE (default 0.1), decided
+# once per invocation so a sampled request is logged completely; the
+# summary line and errors are always logged. Payload fields (image
+# bytes, base64 data, request bodies) are never written, and long
+# strings are truncated.
+#
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# field names that may hold payloads and are never logged
+redacted_fields = {'body', 'data', 'datastr', 'image', 'images', 'Body', 'upload'}
+
+max_field_length = 200
+
+
+def sample_rate():
+    try:
+        return float(os.environ.get('LOG_SAMPLE_RATE', '0.1'))
+    except ValueError:
+        return 0.1
+
+
+def clean(fields):
+    cleaned = {}
+    for key, value in fields.items():
+        if key in redacted_fields:
+            continue
+        if isinstance(value, bytes):
+            value = "<%d bytes>" % len(value)
+        elif isinstance(value, str) and len(value) > max_field_length:
+            value = value[:max_field_length] + "..."
+        cleaned[key] = value
+    return cleaned
+
+
+class Trace:
+    def __init__(self, lambda_name, request_id=None, sampled=None):
+        self.fields = {'lambda': lambda_name, 'request_id': request_id}
+        self.sampled = random.random() < sample_rate() if sampled is None else sampled
+        self.stages = {}
+        self.stages_lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    def bind(self, **fields):
+        #
+        # correlation fields added to every later line
+        #
+        self.fields.update(clean(fields))
+
+    def emit(self, level, msg, fields):
+        line = dict(self.fields, level=level, msg=msg, ts=round(time.time(), 3))
+        line.update(clean(fields))
+        print(json.dumps(line, default=str), file=sys.stdout, flush=True)
+
+    def event(self, msg, **fields):
+        if self.sampled:
+            self.emit('info', msg, fields)
+
+    def error(self, msg, **fields):
+        self.emit('error', msg, fields)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, start)
+
+    def add_stage(self, name, start):
+        #
+        # adds the time since start (a perf_counter value) to the
+        # stage; repeated stages (e.g. one SQL query per batch) accumulate
+        #
+        ms = 1000.0 * (time.perf_counter() - start)
+        with self.stages_lock:
+            self.stages[name] = round(self.stages.get(name, 0.0) + ms, 3)
+
+    def finish(self, status_code, **fields):
+        fields = dict(fields,
+                      status_code=status_code,
+                      duration_ms=round(1000.0 * (time.perf_counter() - self.started), 3),
+                      stages_ms=self.stages)
+        self.emit('info' if status_code < 400 else 'error', 'done', fields)
+
+
+_current = Trace('unknown', sampled=False)
+
+
+def start(lambda_name, context=None):
+    #
+    # begins the trace for one invocation and makes it current
+    #
+    global _current
+    request_id = getattr(context, 'aws_request_id', None)
+    _current = Trace(lambda_name, request_id)
+    return _current
+
+
+def current():
+    return _current
+
+
+def stage(name):
+    return _current.stage(name)
@@ -0,0 +1,424 @@
+#
+# Long-running alternative to the S3-triggered compute lambda: a pool of
+# worker processes that drain 'pending' rows from imagePredictions in
+# batches.
+#
+# Re-scoring (e.g. after setting rows back to 'pending' for a new
+# model) is decode-light: an image's stored 3x32x32 model input
+# (modelInputs/, written by compute) is sent instead of the original
+# whenever it exists, and inputs missing for older images are stored
+# the first time they are computed. Run it with --model-version set to
+# the new model (and move the lambdas' MODEL_VERSION to it too), so the
+# rows record it and cached results of the old model stop being served.
+#
+# Each worker claims up to --batch-size jobs with
+# SELECT ... FOR UPDATE SKIP LOCKED, so concurrent workers never wait on
+# or double-claim each other's rows, and marks them 'in_progress' with
+# its id and the claim time. It then fetches the images, scores them as
+# one batch and writes all results back with one UPDATE. A claim older
+# than --lease seconds is treated as abandoned by a dead worker and
+# becomes claimable again. Jobs whose image couldn't be fetched or
+# whose scoring call failed are given back as 'pending' at once. Both
+# count as failed attempts, and a job is marked 'error' after
+# --max-attempts of them.
+#
+# Run against RDS with the lambdas' config.ini:
+#
+#   python worker.py --workers 4
+#
+# or locally against any MySQL 8 / MariaDB 10.6+ stand-in, e.g.
+#
+#   docker run -d -p 3306:3306 -e MYSQL_ROOT_PASSWORD=... mysql:8
+#   mysql ... < finalProjectCreateDatabase.sql
+#   python worker.py --config local.ini --engine local \
+#                    --images-dir ./images --workers 4
+#
+# where local.ini has the same [rds] section pointing at the stand-in,
+# --images-dir holds the objects under their bucket keys and
+# --engine local runs the CNN from ./sagemaker in-process instead of
+# calling the SageMaker endpoint.
+#
+
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import runtime
+import predictions
+import resultcache
+
+s3_profile = 'blake'
+
+
+def claim_jobs(dbConn, worker_id, batch_size, lease, max_attempts):
+    """
+    Claims up to batch_size claimable jobs for worker_id and returns
+    their image ids: first jobs whose claim expired, then pending ones.
+    An expired claim counts as a failed attempt, so a job that keeps
+    killing its worker is marked 'error' after max_attempts.
+    """
+    with runtime.transaction(dbConn) as dbCursor:
+        #
+        # each query is a range scan of INDEX (status, claimed_at) that
+        # stops at LIMIT, so it locks only the rows it returns; an
+        # ORDER BY the index can't serve would read and lock every
+        # pending row first, and other workers would skip them all
+        #
+        sql1 = """
+        SELECT prediction_id, image_id, attempts FROM imagePredictions
+        WHERE status = 'in_progress' AND claimed_at < NOW() - INTERVAL %s SECOND
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED;"""
+
+        dbCursor.execute(sql1, [lease, batch_size])
+        expired = dbCursor.fetchall()
+        given_up = [row for row in expired if row[2] + 1 >= max_attempts]
+        reclaimed = [row for row in expired if row[2] + 1 < max_attempts]
+
+        pending = []
+        if len(reclaimed) < batch_size:
+            sql2 = """
+            SELECT prediction_id, image_id, attempts FROM imagePredictions
+            WHERE status = 'pending'
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED;"""
+
+            dbCursor.execute(sql2, [batch_size - len(reclaimed)])
+            pending = dbCursor.fetchall()
+
+        def update(assignments, params, rows):
+            if rows:
+                dbCursor.execute(
+                    "UPDATE imagePredictions SET " + assignments +
+                    " WHERE prediction_id IN (" + ",".join(["%s"] * len(rows)) + ");",
+                    params + [row[0] for row in rows])
+
+        update("status = 'error', attempts = attempts + 1, "
+               "claimed_by = NULL, claimed_at = NULL", [], given_up)
+        update("status = 'in_progress', attempts = attempts + 1, "
+               "claimed_by = %s, claimed_at = NOW()", [worker_id], reclaimed)
+        update("status = 'in_progress', "
+               "claimed_by = %s, claimed_at = NOW()", [worker_id], pending)
+
+    image_ids = [row[1] for row in reclaimed + pending]
+    if not image_ids:
+        return []
+
+    # a job scored again isn't finished until this worker says so
+    result_cache = resultcache.cache()
+    result_cache.forget_statuses(image_ids)
+    result_cache.invalidate(image_ids)
+    return image_ids
+
+
+def release_jobs(dbConn, worker_id, image_ids, max_attempts):
+    """
+    Gives back jobs worker_id claimed but couldn't score: 'pending'
+    again, or 'error' once they have failed max_attempts times.
+    """
+    if not image_ids:
+        return
+
+    with runtime.transaction(dbConn) as dbCursor:
+        sql = """
+        UPDATE imagePredictions
+        SET status = IF(attempts + 1 >= %s, 'error', 'pending'),
+            attempts = attempts + 1, claimed_by = NULL, claimed_at = NULL
+        WHERE image_id IN (""" + ",".join(["%s"] * len(image_ids)) + """)
+          AND claimed_by = %s;"""
+
+        dbCursor.execute(sql, [max_attempts] + list(image_ids) + [worker_id])
+
+
+def bucket_keys(dbConn, image_ids):
+    sql = "SELECT image_id, bucket_key FROM imageMetadata WHERE image_id IN (" + \
+        ",".join(["%s"] * len(image_ids)) + ");"
+
+    dbCursor = dbConn.cursor()
+    try:
+        dbCursor.execute(sql, list(image_ids))
+        return dict(dbCursor.fetchall())
+    finally:
+        dbCursor.close()
+
+
+class S3Images:
+    def __init__(self):
+        self.s3_client = runtime.client('s3', s3_profile)
+        self.bucketname = runtime.config().get('s3', 'bucket_name')
+
+    def get(self, bucket_key):
+        """
+        The image's stored ModelInput if it has one, else the original.
+        """
+        model_input = predictions.fetch_model_input(self.s3_client, self.bucketname, bucket_key)
+        if model_input is not None:
+            return model_input
+        response = self.s3_client.get_object(Bucket=self.bucketname, Key=bucket_key)
+        return response['Body'].read()
+
+    def put_model_input(self, bucket_key, model_input):
+        predictions.store_model_input(self.s3_client, self.bucketname, bucket_key, model_input)
+
+
+class LocalImages:
+    def __init__(self, images_dir):
+        self.images_dir = images_dir
+
+    def get(self, bucket_key):
+        path = os.path.join(self.images_dir, predictions.model_input_key(bucket_key))
+        if os.path.exists(path):
+            with open(path, "rb") as infile:
+                return predictions.ModelInput(infile.read())
+        with open(os.path.join(self.images_dir, bucket_key), "rb") as infile:
+            return infile.read()
+
+    def put_model_input(self, bucket_key, model_input):
+        path = os.path.join(self.images_dir, predictions.model_input_key(bucket_key))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as outfile:
+            outfile.write(model_input)
+
+
+class EndpointScorer:
+    def __init__(self, model_version=None):
+        self.sagemaker_runtime = runtime.client('sagemaker-runtime', s3_profile)
+        self.model_version = model_version
+
+    def score(self, images):
+        """
+        (scored, model_inputs) where model_inputs holds the ModelInput
+        computed for each original image (None for stored inputs).
+        scored is None for images whose call failed.
+        """
+        if all(isinstance(image, predictions.ModelInput) for image in images):
+            return predictions.invoke_endpoint_batch(self.sagemaker_runtime, images,
+                                                     self.model_version), \
+                [None] * len(images)
+
+        scored, model_inputs = predictions.invoke_endpoint_batch(
+            self.sagemaker_runtime, images, self.model_version, return_inputs=True)
+        return scored, [None if isinstance(image, predictions.ModelInput) else model_input
+                        for image, model_input in zip(images, model_inputs)]
+
+
+class LocalScorer:
+    """
+    Runs the CNN in this process with the serving container's own
+    preprocessing and engine code from ./sagemaker.
+    """
+
+    def __init__(self, model_path, backend):
+        here = os.path.dirname(os.path.abspath(__file__))
+        sys.path.insert(0, os.path.join(here, 'sagemaker'))
+
+        import numpy as np
+        import engines
+        import preprocess
+
+        self.np = np
+        self.preprocess = preprocess
+        # memory-mapped, so all worker processes share one weight copy
+        self.engine = engines.load_engine(model_path, backend, mmap=True)
+
+    def score(self, images):
+        scored = [None] * len(images)
+        computed = [None] * len(images)
+        model_inputs = []
+        positions = []
+        for i, image in enumerate(images):
+            try:
+                if isinstance(image, predictions.ModelInput):
+                    model_input = self.preprocess.from_npy(image)
+                    if model_input.ndim != 3:
+                        raise ValueError("expected one (3, 32, 32) model input")
+                else:
+                    model_input = self.preprocess.preprocess(image)
+                    computed[i] = predictions.ModelInput(self.preprocess.to_npy(model_input))
+                model_inputs.append(model_input)
+                positions.append(i)
+            except Exception as e:
+                scored[i] = (None, str(e))
+
+        if model_inputs:
+            out = self.np.empty((len(model_inputs), 3, 32, 32), dtype=self.np.float32)
+            batch = self.preprocess.fill_batch(model_inputs, out)
+            for i, prob in zip(positions, self.engine(batch).tolist()):
+                scored[i] = (predictions.to_percentage_ai(prob), None)
+
+        return scored, computed
+
+
+def process_batch(dbConn, worker_id, image_ids, images, scorer, pool, max_attempts,
+                  model_version=None):
+    keys = bucket_keys(dbConn, image_ids)
+
+    def fetch(image_id):
+        try:
+            return images.get(keys[image_id]), None
+        except Exception as e:
+            return None, str(e)
+
+    fetched = list(pool.map(fetch, image_ids))
+
+    ready = [(image_id, data) for image_id, (data, error) in zip(image_ids, fetched)
+             if error is None]
+    # given back to be retried
+    failed = []
+    for image_id, (_, error) in zip(image_ids, fetched):
+        if error is not None:
+            print(worker_id, "image", image_id, "fetch failed:", error)
+            failed.append(image_id)
+
+    if not ready:
+        release_jobs(dbConn, worker_id, failed, max_attempts)
+        return 0
+
+    scored, computed = scorer.score([data for _, data in ready])
+
+    def store(item):
+        image_id, model_input = item
+        try:
+            images.put_model_input(keys[image_id], model_input)
+        except Exception as e:
+            # only costs a decode the next time it is scored
+            print(worker_id, "image", image_id, "storing model input failed:", str(e))
+
+    stores = [pool.submit(store, (image_id, model_input))
+              for (image_id, _), model_input in zip(ready, computed)
+              if model_input is not None]
+
+    results = []
+    for (image_id, _), entry in zip(ready, scored):
+        if entry is None:
+            failed.append(image_id)
+            continue
+        percentage, error = entry
+        if error is None:
+            results.append((image_id, percentage, 'complete'))
+        else:
+            print(worker_id, "image", image_id, "scoring failed:", error)
+            results.append((image_id, 0, 'error'))
+
+    written = predictions.write_predictions(dbConn, results, claimed_by=worker_id,
+                                            model_version=model_version)
+    if failed:
+        print(worker_id, len(failed), "jobs given back after a failed scoring call or fetch")
+        release_jobs(dbConn, worker_id, failed, max_attempts)
+    for future in stores:
+        future.result()
+    return written
+
+
+def run_worker(args, index):
+    runtime.config(args.config)
+
+    worker_id = "%s-%d-%s" % (socket.gethostname(), index, uuid.uuid4().hex[:8])
+
+    # finish the current batch, then stop
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda *_: stopping.append(True))
+
+    if args.images_dir:
+        images = LocalImages(args.images_dir)
+    else:
+        images = S3Images()
+
+    if args.engine == 'local':
+        scorer = LocalScorer(args.model, args.backend)
+    else:
+        scorer = EndpointScorer(args.model_version)
+
+    done = 0
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=args.fetch_workers) as pool:
+        while not stopping:
+            written = 0
+            try:
+                with runtime.db() as dbConn:
+                    image_ids = claim_jobs(dbConn, worker_id, args.batch_size, args.lease,
+                                           args.max_attempts)
+                    if image_ids:
+                        written = process_batch(dbConn, worker_id, image_ids, images, scorer,
+                                                pool, args.max_attempts, args.model_version)
+                        done += written
+            except Exception as e:
+                print(worker_id, "**ERROR**", str(e))
+                image_ids = []
+
+            if image_ids:
+                elapsed = time.monotonic() - started
+                print(worker_id, "batch:", len(image_ids), "done:", done,
+                      "rate: %.1f/s" % (done / elapsed if elapsed else 0.0))
+                if not written:
+                    # nothing could be scored (e.g. the endpoint is down),
+                    # so don't claim the same jobs straight back
+                    time.sleep(args.idle_sleep)
+            elif args.once:
+                break
+            else:
+                time.sleep(args.idle_sleep)
+
+    print(worker_id, "stopped after", done, "jobs")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Drain pending imagePredictions rows in batches")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--lease", type=int, default=300,
+                        help="seconds before an unfinished claim expires")
+    parser.add_argument("--idle-sleep", type=float, default=2.0,
+                        help="seconds to wait when nothing is pending")
+    parser.add_argument("--max-attempts", type=int, default=5,
+                        help="failed scoring calls or expired claims before a job "
+                             "is marked error")
+    parser.add_argument("--once", action="store_true",
+                        help="exit once nothing is pending")
+    parser.add_argument("--config", default="config.ini")
+    parser.add_argument("--fetch-workers", type=int, default=8,
+                        help="concurrent image downloads per worker")
+    parser.add_argument("--images-dir",
+                        help="read images from here instead of S3")
+    parser.add_argument("--engine", choices=["endpoint", "local"], default="endpoint")
+    parser.add_argument("--model", default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "sagemaker", "model_state_dict.pt"))
+    parser.add_argument("--backend", default="eager",
+                        help="inference backend for --engine local")
+    parser.add_argument("--model-version",
+                        help="model_version to score with and record, e.g. when "
+                             "re-scoring with a new model (default: the endpoint's "
+                             "default, and each row keeps its model_version)")
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        run_worker(args, 0)
+        return
+
+    processes = [multiprocessing.Process(target=run_worker, args=(args, i))
+                 for i in range(args.workers)]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -19,12 +19,237 @@ import pathlib
 import base64
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pathlib
 import logging
 import sys
+import io
+import time
+import hashlib
+import glob
+import csv
+import json
+import argparse
+import concurrent.futures
+import os
+import sqlite3
+import threading
 
 import matplotlib.pyplot as plt
 import matplotlib.image as img
+from PIL import Image
+
+# the size the server resizes every image to before the model sees it
+INPUT_SIZE = (32, 32)
+
+# where results are remembered between runs, and how much they may take
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".artifact", "results.sqlite3")
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# a finished result can still change when the service re-scores it with
+# a new model, so one older than this is checked again (metadata only)
+CACHE_MAX_AGE = 24 * 3600
+
+# statuses after which a job never changes
+FINAL_STATUSES = ("complete", "error")
+
+############################################################
+#
+# cache
+#
+
+
+class LocalCache:
+    """
+    On-disk SQLite cache of what the service said about each local
+    file, keyed by the SHA-256 of the file's content: its image id,
+    status, prediction and, once retrieved, the image itself. Files
+    seen before are never uploaded again, finished results are
+    answered without contacting the service at all, and unfinished
+    ones only need to be polled.
+
+    Results retrieved by image id alone are kept under "image:<id>".
+    The cache is bounded to max_bytes; the least recently used
+    entries are evicted first. It is safe to use from several
+    threads. checked_at is when the service last confirmed an entry,
+    see recheck().
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key            TEXT PRIMARY KEY,
+                image_id       INTEGER,
+                status         TEXT,
+                precentage_ai  REAL,
+                model_version  TEXT,
+                file_name      TEXT,
+                image          BLOB,
+                size           INTEGER NOT NULL,
+                last_used      REAL NOT NULL,
+                checked_at     REAL NOT NULL DEFAULT 0
+            )""")
+        try:
+            # caches written before entries were re-checked
+            self.db.execute("ALTER TABLE results ADD COLUMN checked_at REAL NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_image_id ON results(image_id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results(last_used)")
+        self.db.commit()
+
+        self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    COLUMNS = ["key", "image_id", "status", "precentage_ai", "model_version", "file_name", "image",
+               "checked_at"]
+
+    def _get(self, where, value):
+        with self.lock:
+            row = self.db.execute("SELECT " + ", ".join(self.COLUMNS) + " FROM results WHERE " +
+                                  where + " = ? ORDER BY last_used DESC LIMIT 1", (value,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), row[0]))
+            self.db.commit()
+            return dict(zip(self.COLUMNS, row))
+
+    def get(self, digest):
+        return self._get("key", digest)
+
+    def get_by_image_id(self, imageid):
+        return self._get("image_id", int(imageid))
+
+    def put(self, digest, imageid, status, precentage_ai=None, model_version=None, file_name=None):
+        self._write(digest, imageid, status, precentage_ai, model_version, file_name, None)
+
+    def update_result(self, imageid, body):
+        """
+        Records a retrieve response for imageid on every entry that
+        has it, or under "image:<id>" if none does.
+        """
+        image = base64.b64decode(body["image"]) if body.get("image") else None
+
+        with self.lock:
+            keys = [row[0] for row in self.db.execute(
+                "SELECT key FROM results WHERE image_id = ?", (int(imageid),))]
+        for key in keys or ["image:" + str(imageid)]:
+            self._write(key, imageid, body.get("status"), body.get("precentage_ai"),
+                        body.get("model_version"), body.get("file_name"), image)
+
+    def _write(self, key, imageid, status, precentage_ai, model_version, file_name, image):
+        size = 200 + (len(image) if image else 0)
+        with self.lock:
+            old = self.db.execute("SELECT size, image FROM results WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.total -= old[0]
+                if image is None and old[1] is not None:
+                    # keep an image retrieved earlier
+                    image = old[1]
+                    size += len(image)
+
+            now = time.time()
+            self.db.execute("""
+                INSERT OR REPLACE INTO results
+                  (key, image_id, status, precentage_ai, model_version, file_name, image, size,
+                   last_used, checked_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (key, int(imageid), status, precentage_ai, model_version, file_name, image,
+                 size, now, now))
+            self.total += size
+
+            if self.total > self.max_bytes:
+                self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        # down to 90% of the limit, so not every write evicts
+        for key, size in self.db.execute(
+                "SELECT key, size FROM results ORDER BY last_used").fetchall():
+            if self.total <= 0.9 * self.max_bytes:
+                break
+            self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+            self.total -= size
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def recheck(baseurl, cache, entry, session=requests):
+    """
+    entry, or None if there is none, checked again first if it is
+    stale (see recheck_many).
+    """
+
+    return recheck_many(baseurl, cache, [entry], session)[0]
+
+
+def recheck_many(baseurl, cache, entries, session=requests):
+    """
+    entries, a list of cache entries or None, in which every finished
+    entry not confirmed by the service for CACHE_MAX_AGE seconds is
+    first checked again, RETRIEVE_CHUNK ids per batch retrieve call, and
+    updated if its job was re-scored since. When the service can't be
+    reached the entries are used as they are.
+    """
+
+    now = time.time()
+    stale = {}  # image id -> its stale entries
+    for entry in entries:
+        if entry is not None and entry["status"] in FINAL_STATUSES and \
+                now - entry["checked_at"] >= CACHE_MAX_AGE:
+            stale.setdefault(entry["image_id"], []).append(entry)
+
+    stale_ids = list(stale)
+    for start in range(0, len(stale_ids), RETRIEVE_CHUNK):
+        imageids = stale_ids[start:start + RETRIEVE_CHUNK]
+
+        try:
+            res = session.get(baseurl + '/retrieve',
+                              params={"image_ids": ",".join(str(i) for i in imageids)})
+        except requests.RequestException:
+            continue
+        if res.status_code != 200:
+            continue
+
+        for body in res.json()["results"]:
+            if not body.get("found") or body.get("status") is None:
+                continue
+            cache.update_result(body["image_id"], body)
+            for entry in stale.get(int(body["image_id"]), []):
+                entry.update(status=body["status"],
+                             precentage_ai=body.get("precentage_ai"),
+                             model_version=body.get("model_version"),
+                             checked_at=time.time())
+
+    return entries
+
+
+def cached_body(entry):
+    """
+    A cache entry in the shape of a retrieve response body.
+    """
+
+    body = {"file_name": entry["file_name"],
+            "status": entry["status"],
+            "precentage_ai": entry["precentage_ai"],
+            "model_version": entry["model_version"]}
+    if entry["image"] is not None:
+        body["image"] = base64.b64encode(entry["image"]).decode()
+    return body
 
 ############################################################
 #
@@ -50,6 +275,8 @@ def prompt():
     print("   0 => end")
     print("   1 => upload")
     print("   2 => retrieve")
+    print("   3 => upload and wait for the result")
+    print("   4 => compare full and model-input-only upload")
 
     cmd = input()
 
@@ -68,82 +295,324 @@ def prompt():
 #
 
 
-def upload(baseurl):
+def model_input_png(data):
     """
-    Prompts the user for a local filename, 
-    and uploads that asset (jpg/jpeg/png) to S3 for processing. 
+    Shrinks an encoded image exactly the way the server's
+    preprocessing does (JPEG draft decoding, RGB, bicubic resize to
+    32x32) and returns it PNG encoded. The server decodes it to the
+    same model input it would have computed from the original, from
+    a ~3 KB upload instead of several MB.
+
+    Parameters
+    ----------
+    data: bytes of a .jpg/.jpeg/.png file
+
+    Returns
+    -------
+    bytes of the 32x32 PNG
+    """
+
+    image = Image.open(io.BytesIO(data))
+    if image.format == "JPEG":
+        image.draft("RGB", INPUT_SIZE)
+    if image.mode != "RGB":
+        if image.mode == "P" and "transparency" in image.info:
+            image = image.convert("RGBA")
+        image = image.convert("RGB")
+    image.load()
+    image = image.resize(INPUT_SIZE, Image.BICUBIC)
+
+    out = io.BytesIO()
+    image.save(out, format="PNG")
+    return out.getvalue()
+
+
+def read_upload(local_filename, model_input_only=False):
+    """
+    Reads a local file and prepares what is sent for it.
+
+    Returns
+    -------
+    dict with "filename" (the file's name, without the local
+    directories) and "data" as they are sent, "digest", the
+    SHA-256 of the file itself (the local cache key), and
+    "original_bytes" and "resize_seconds"
+    """
+
+    infile = open(local_filename, "rb")
+    bytes = infile.read()
+    infile.close()
+
+    filename = pathlib.Path(local_filename).name
+    resize_seconds = 0.0
+    if model_input_only:
+        started = time.perf_counter()
+        data = model_input_png(bytes)
+        resize_seconds = time.perf_counter() - started
+        filename = pathlib.Path(filename).with_suffix(".png").name
+    else:
+        data = bytes
+
+    return {"filename": filename,
+            "data": data,
+            "digest": hashlib.sha256(bytes).hexdigest(),
+            "original_bytes": len(bytes),
+            "resize_seconds": resize_seconds}
+
+
+def upload_entry(prepared):
+    # what the web service is told about a file before it is sent
+    return {"filename": prepared["filename"],
+            "size": len(prepared["data"]),
+            "sha256": hashlib.sha256(prepared["data"]).hexdigest()}
+
+
+def cached_upload(baseurl, cache, prepared, session=requests):
+    """
+    The cached answer for a file uploaded before, marked "cached", or
+    None if it has to be uploaded.
+    """
+
+    return cached_answer(prepared, recheck(baseurl, cache, cache.get(prepared["digest"]), session))
+
+
+def cached_answer(prepared, entry):
+    # a (re-checked) cache entry in the shape upload_file answers with
+    if entry is None:
+        return None
+    return {"imageID": entry["image_id"],
+            "cached": True,
+            "status": entry["status"],
+            "precentage_ai": entry["precentage_ai"],
+            "model_version": entry["model_version"],
+            "original_bytes": prepared["original_bytes"],
+            "sent_bytes": 0,
+            "resize_seconds": 0.0,
+            "upload_seconds": 0.0}
+
+
+def store_upload(upload, prepared, session=requests):
+    """
+    Posts a file's bytes to the presigned upload the web service
+    handed out for it.
+    """
+
+    res = session.post(upload["url"],
+                       data=upload["fields"],
+                       files={"file": (pathlib.Path(prepared["filename"]).name, prepared["data"])})
+
+    if res.status_code not in (200, 201, 204):
+        raise Exception("upload to storage failed: " + str(res.status_code) + " " + res.text)
+
+
+def finish_upload(body, prepared, started, cache=None):
+    """
+    The web service's answer for an uploaded file, recorded in cache,
+    with the upload statistics added.
+    """
+
+    body.pop("upload", None)
+
+    if cache is not None:
+        cache.put(prepared["digest"], body["imageID"], body.get("status", "pending"),
+                  body.get("precentage_ai"), body.get("model_version"), prepared["filename"])
+
+    body["original_bytes"] = prepared["original_bytes"]
+    body["sent_bytes"] = 0 if body.get("duplicate") else len(prepared["data"])
+    body["resize_seconds"] = prepared["resize_seconds"]
+    body["upload_seconds"] = time.perf_counter() - started
+    return body
+
+
+def upload_file(baseurl, local_filename, model_input_only=False, session=requests, cache=None):
+    """
+    Uploads one local file without prompting: asks the web service
+    for an image id and a presigned upload, then posts the bytes
+    straight to S3. Raises an Exception if any step fails.
 
     Parameters
     ----------
     baseurl: baseurl for web service
+    local_filename: path of a .jpg/.jpeg/.png file
+    model_input_only: upload only the 32x32 image the model sees
+        (see model_input_png) rather than the full-resolution file
+    session: requests, or a requests.Session to reuse connections
+    cache: a LocalCache; a file uploaded before isn't uploaded
+        again, its cached answer is returned marked "cached"
 
     Returns
     -------
-    image_id: id of the uploaded image
+    dict with the service's answer ("imageID", and for an image
+    analyzed before "duplicate", "status" and "precentage_ai") plus
+    "original_bytes", "sent_bytes", "resize_seconds" and
+    "upload_seconds"
+    """
+
+    prepared = read_upload(local_filename, model_input_only)
+
+    if cache is not None:
+        result = cached_upload(baseurl, cache, prepared, session)
+        if result is not None:
+            return result
+
+    started = time.perf_counter()
+
+    #
+    # ask the web service for an image id and a presigned
+    # upload; only the filename, size and content hash go
+    # through the API, the image itself goes straight to S3
+    # below (unless the same image was already analyzed):
+    #
+    res = session.post(baseurl + '/upload', json=upload_entry(prepared))
+
+    body = res.json()
+    if res.status_code != 200:
+        raise Exception(body)
+
+    if not body.get("duplicate"):
+        #
+        # now upload the raw bytes to the presigned POST:
+        #
+        store_upload(body["upload"], prepared, session)
+
+    return finish_upload(body, prepared, started, cache)
+
+
+def print_upload_stats(label, result):
+    print(label, ":", result["sent_bytes"], "of", result["original_bytes"], "bytes sent",
+          "(%.1f%%)," % (100.0 * result["sent_bytes"] / max(result["original_bytes"], 1)),
+          "%.3f s" % (result["resize_seconds"] + result["upload_seconds"]),
+          "(resize %.3f s, upload %.3f s)" % (result["resize_seconds"], result["upload_seconds"]))
+
+
+def prompt_filename():
+    """
+    Prompts for a local .jpg/.jpeg/.png filename, returns None if it
+    is not one.
     """
 
     print()
     print("Enter filename>")
     local_filename = input()
 
-    if [".jpg", ".jpeg"].count(pathlib.Path(local_filename).suffix) == 0:
+    if pathlib.Path(local_filename).suffix not in UPLOAD_EXTENSIONS:
         print("file '", local_filename,
-              "' does not have a .jpg or .jpeg extension...")
+              "' does not have a .jpg, .jpeg or .png extension...")
         return
 
     if not pathlib.Path(local_filename).is_file():
         print("file '", local_filename, "' does not exist...")
         return
 
-    try:
-        #
-        # build the data packet:
-        #
-        infile = open(local_filename, "rb")
-        bytes = infile.read()
-        infile.close()
+    return local_filename
 
-        #
-        # now encode the image as base64. Note b64encode returns
-        # a bytes object, not a string. So then we have to convert
-        # (decode) the bytes -> string, and then we can serialize
-        # the string as JSON for upload to server:
-        #
-        data = base64.b64encode(bytes)
-        datastr = data.decode()
 
-        data = {"filename": local_filename,
-                "data": datastr}
+def upload(baseurl, cache=None):
+    """
+    Prompts the user for a local filename, 
+    and uploads that asset (jpg/jpeg/png) to S3 for processing. 
+    The user can choose to upload only the 32x32 image the model
+    sees, which is much faster, instead of the full-resolution file.
 
-        #
-        # call the web service:
-        #
-        api = '/upload'
-        url = baseurl + api
-        res = requests.post(url, json=data)
+    Parameters
+    ----------
+    baseurl: baseurl for web service
+    cache: a LocalCache, so a file uploaded before isn't uploaded again
 
-        body = res.json()
+    Returns
+    -------
+    image_id: id of the uploaded image
+    """
 
-        #
-        # let's look at what we got back:
-        #
-        if res.status_code != 200:
+    local_filename = prompt_filename()
+    if local_filename is None:
+        return
+
+    print("Upload only the 32x32 model input instead of the full image? (y/n)>")
+    model_input_only = input().strip().lower() in ("y", "yes")
+
+    try:
+        result = upload_file(baseurl, local_filename, model_input_only, cache=cache)
+
+        if result.get("cached"):
+            #
+            # uploaded from here before, nothing to upload
+            #
             print()
-            print(body)
+            print("uploaded before as imageid", result["imageID"], "- status:", result["status"])
+            return result["imageID"]
+
+        if result.get("duplicate"):
             #
-            return
+            # this exact image was analyzed before, nothing to upload
+            #
+            print()
+            print("already analyzed as imageid", result["imageID"], "- AI likelihood:",
+                  result["precentage_ai"], "%")
+            return result["imageID"]
 
         #
         # return message
         #
         print()
-        print("uploaded: ", body["imageID"])
-        print("** Save the above number, this is your imageid. Run 'retrieve' to see the AI prediction on this image. **")
-        return
+        print_upload_stats("model input" if model_input_only else "full image", result)
+        print("uploaded: ", result["imageID"])
+        print("** Save the above number, this is your imageid.",
+              "Run 'retrieve' to see the AI prediction on this image. **")
+        return result["imageID"]
 
     except Exception as e:
         logging.error("upload() failed:")
-        logging.error("url: " + url)
+        logging.error("file: " + local_filename)
+        logging.error(e)
+        return
+
+
+def compare_upload_modes(baseurl):
+    """
+    Prompts for a local filename and uploads it twice, full size and
+    as the 32x32 model input only, then reports the bytes sent and
+    time taken by each, and both predictions once they are done.
+
+    Parameters
+    ----------
+    baseurl: baseurl for web service
+
+    Returns
+    -------
+    nothing
+    """
+
+    local_filename = prompt_filename()
+    if local_filename is None:
+        return
+
+    try:
+        full = upload_file(baseurl, local_filename)
+        small = upload_file(baseurl, local_filename, model_input_only=True)
+
+        print()
+        print_upload_stats("full image ", full)
+        print_upload_stats("model input", small)
+        if full["upload_seconds"] > 0:
+            print("model input upload is %.1fx faster" %
+                  ((full["resize_seconds"] + full["upload_seconds"]) /
+                   max(small["resize_seconds"] + small["upload_seconds"], 1e-9)))
+
+        print()
+        print("waiting for both predictions...")
+        for label, result in (("full image ", full), ("model input", small)):
+            body = result if result.get("duplicate") else wait_for_result(baseurl, result["imageID"])
+            if body is None:
+                print(label, ": imageid", result["imageID"], "still pending")
+            else:
+                print(label, ": imageid", result["imageID"], "-", body["status"],
+                      body.get("precentage_ai"), "%")
+        return
+
+    except Exception as e:
+        logging.error("compare_upload_modes() failed:")
+        logging.error("file: " + local_filename)
         logging.error(e)
         return
 
@@ -153,7 +622,7 @@ def upload(baseurl):
 #
 
 
-def retrieve(baseurl):
+def retrieve(baseurl, cache=None):
     """
     Prompts the user for the image id, and returns the
     that percentage of the image being AI generated 
@@ -165,6 +634,8 @@ def retrieve(baseurl):
     Parameters
     ----------
     baseurl: baseurl for web service
+    cache: a LocalCache; finished results retrieved before are shown
+        from it without calling the web service
 
     Returns
     -------
@@ -176,13 +647,20 @@ def retrieve(baseurl):
     print("Enter image id>")
     imageid = input()
 
+    api = '/retrieve'
+    url = baseurl + api + '/' + imageid
+
     try:
+        if cache is not None and imageid.isnumeric():
+            entry = recheck(baseurl, cache, cache.get_by_image_id(imageid))
+            if entry is not None and entry["status"] in FINAL_STATUSES and \
+                    (entry["image"] is not None or entry["status"] != "complete"):
+                show_result(cached_body(entry))
+                return
+
         #
         # call the web service:
         #
-        api = '/retrieve'
-        url = baseurl + api + '/' + imageid
-
         res = requests.get(url)
 
         #
@@ -197,56 +675,498 @@ def retrieve(baseurl):
             #
             return
 
+        if cache is not None and body["status"] in FINAL_STATUSES:
+            cache.update_result(imageid, body)
+
+        show_result(body)
+        return
+
+    except Exception as e:
+        logging.error("retrieve() failed:")
+        logging.error("url: " + url)
+        logging.error(e)
+        return
+
+
+def show_result(body):
+    """
+    Prints a retrieve response and, once the prediction is
+    complete, shows the image it is for.
+
+    Parameters
+    ----------
+    body: decoded JSON body of a retrieve response
+
+    Returns
+    -------
+    nothing
+    """
+
+    print()
+    print("Filename      : ", body["file_name"])
+    if (body["status"] != "complete"):
+        # print status if pending
+        print("Status        : ", body["status"])
+    else:
+        # output percentage if status complete
+        print("AI likelihood : ", body["precentage_ai"], "%")
+        print("** The likelihood of",
+              body["file_name"], "being AI generated is", body["precentage_ai"], "% **")
+
+        if not body.get("image"):
+            return
+
         print()
-        print("Filename      : ", body["file_name"])
-        if (body["status"] != "complete"):
-            # print status if pending
-            print("Status        : ", body["status"])
-        else:
-            # output percentage if status complete
-            print("AI likelihood : ", body["precentage_ai"], "%")
-            print("** The likelihood of",
-                  body["file_name"], "being AI generated is", body["precentage_ai"], "% **")
-            print()
-            print("Close your image to continue")
+        print("Close your image to continue")
 
-            #
-            # retrieve the image
-            #
-            datastr = body["image"]
+        #
+        # decode the image and show it straight from memory, so
+        # no file is written (or overwritten) on disk
+        #
+        bytes = base64.b64decode(body["image"])
 
-            bytes = base64.b64decode(datastr)
+        display = True
 
-            filename = body["file_name"]
+        if display:
+            image = Image.open(io.BytesIO(bytes))
+            plt.imshow(image)
+            plt.show()
 
-            #
-            # write the binary data to a file (as a
-            # binary file, not a text file):
-            #
-            outfile = open(filename, "wb")
-            outfile.write(bytes)
-            outfile.close()
 
-            display = True
+############################################################
+#
+# upload and wait
+#
+
 
-            if display:
-                image = img.imread(filename)
-                plt.imshow(image)
-                plt.show()
+def wait_for_result(baseurl, imageid, max_wait=300, session=requests, cache=None):
+    """
+    Waits for a prediction with long-poll retrieve calls: the server
+    holds each call open until the job finishes (or ~25 seconds
+    pass), so a finished job usually takes a single call.
 
+    Parameters
+    ----------
+    baseurl: baseurl for web service
+    imageid: id of the uploaded image
+    max_wait: seconds to wait in total before giving up
+    session: requests, or a requests.Session to reuse connections
+    cache: a LocalCache; a finished result found there is returned
+        at once, one fetched from the service is stored there
+
+    Returns
+    -------
+    the retrieve response body, None if still unfinished after
+    max_wait seconds; raises an Exception on an error response
+    """
+
+    if cache is not None:
+        entry = recheck(baseurl, cache, cache.get_by_image_id(imageid), session)
+        if entry is not None and entry["status"] in FINAL_STATUSES:
+            return cached_body(entry)
+
+    url = baseurl + '/retrieve/' + str(imageid)
+    headers = {}
+
+    deadline = time.monotonic() + max_wait
+    while time.monotonic() < deadline:
+        res = session.get(url, params={"wait": 25}, headers=headers)
+
+        if res.status_code == 304:
+            # still unfinished, nothing changed since the last call
+            continue
+
+        body = res.json()
+
+        if res.status_code != 200:
+            raise Exception(body)
+
+        if body["status"] not in ("pending", "in_progress"):
+            if cache is not None:
+                cache.update_result(imageid, body)
+            return body
+
+        headers = {"If-None-Match": res.headers.get("ETag", "")}
+
+    return None
+
+
+def upload_and_wait(baseurl, max_wait=300, cache=None):
+    """
+    Uploads a file like 'upload' and then waits for its prediction
+    with wait_for_result, so a finished job usually takes a single
+    retrieve call instead of repeated retries.
+
+    Parameters
+    ----------
+    baseurl: baseurl for web service
+    max_wait: seconds to wait in total before giving up
+
+    Returns
+    -------
+    nothing
+    """
+
+    imageid = upload(baseurl, cache)
+    if imageid is None:
+        return
+
+    try:
+        print()
+        print("waiting for the prediction...")
+
+        body = wait_for_result(baseurl, imageid, max_wait, cache=cache)
+        if body is not None:
+            show_result(body)
+            return
+
+        print()
+        print("** Still pending, run 'retrieve' with imageid", imageid, "later. **")
         return
 
     except Exception as e:
-        logging.error("retrieve() failed:")
-        logging.error("url: " + url)
+        logging.error("upload_and_wait() failed:")
+        logging.error("imageid: " + str(imageid))
         logging.error(e)
         return
 
 
+############################################################
+#
+# batch
+#
+
+
+# file types the upload service accepts
+UPLOAD_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# most image ids per batch retrieve call, kept well below the
+# service's limit so the query string stays short
+RETRIEVE_CHUNK = 100
+
+# most files registered by one batch upload call
+UPLOAD_CHUNK = 100
+
+BATCH_FIELDS = ["file", "image_id", "status", "precentage_ai", "model_version",
+                "duplicate", "cached", "sent_bytes", "error"]
+
+
+def make_session(baseurl, workers):
+    """
+    A requests.Session whose keep-alive connection pools fit the
+    given number of worker threads, and which retries with
+    exponential backoff, honouring Retry-After:
+
+    - GETs to the web service on throttling (429), failures (5xx)
+      and dropped connections
+    - POSTs to its /upload only when throttled or when the
+      connection couldn't be made: one that failed or lost its
+      response may already have created a job, and sending it
+      again would create another that is never uploaded to
+    - POSTs to the presigned uploads on S3's 500 and 503 SlowDown
+      too, as posting again to the same key does no harm
+    """
+
+    def adapter(retry):
+        return HTTPAdapter(pool_connections=4, pool_maxsize=workers, max_retries=retry)
+
+    backoff = dict(total=6, backoff_factor=0.5, respect_retry_after_header=True,
+                   raise_on_status=False)
+
+    api_retry = Retry(status_forcelist=(429, 500, 502, 503, 504), **backoff)
+    upload_retry = Retry(allowed_methods=["POST"], status_forcelist=(429,),
+                         read=0, other=0, **backoff)
+    storage_retry = Retry(allowed_methods=["POST"], status_forcelist=(500, 503), **backoff)
+
+    # requests picks the adapter with the longest matching prefix
+    session = requests.Session()
+    session.mount("https://", adapter(storage_retry))
+    session.mount("http://", adapter(storage_retry))
+    session.mount(baseurl, adapter(api_retry))
+    session.mount(baseurl + "/upload", adapter(upload_retry))
+    return session
+
+
+def find_files(pattern):
+    """
+    The uploadable files in a directory (recursively) or matching a
+    glob pattern, sorted.
+    """
+
+    path = pathlib.Path(pattern)
+    if path.is_dir():
+        files = path.rglob("*")
+    else:
+        files = (pathlib.Path(name) for name in glob.glob(pattern, recursive=True))
+    return sorted(str(f) for f in files if f.is_file() and f.suffix in UPLOAD_EXTENSIONS)
+
+
+class ResultWriter:
+    """
+    Writes one row per file as its result arrives: CSV rows are
+    written (and flushed) immediately, a .json file is written as one
+    list at the end.
+    """
+
+    def __init__(self, out_path):
+        self.out_path = out_path
+        self.rows = []
+        self.as_json = out_path is not None and out_path.endswith(".json")
+        if self.as_json:
+            self.outfile = None
+        else:
+            self.outfile = open(out_path, "w", newline="") if out_path else sys.stdout
+            self.writer = csv.DictWriter(self.outfile, fieldnames=BATCH_FIELDS, extrasaction="ignore")
+            self.writer.writeheader()
+
+    def write(self, row):
+        self.rows.append(row)
+        if not self.as_json:
+            self.writer.writerow(row)
+            self.outfile.flush()
+
+    def close(self):
+        if self.as_json:
+            with open(self.out_path, "w") as outfile:
+                json.dump(self.rows, outfile, indent=2)
+        elif self.outfile is not sys.stdout:
+            self.outfile.close()
+
+
+def collect_results(baseurl, session, pool, waiting, writer, max_wait, cache=None):
+    """
+    Long-polls batch retrieve for every job in waiting ({imageid:
+    [row, ...]}, one row per file, as identical files share a job),
+    RETRIEVE_CHUNK ids per call with the calls running
+    concurrently, and writes a job's rows as soon as it is
+    finished (recording it in cache, if given). Rows still
+    unfinished after max_wait seconds are written with their last
+    status.
+    """
+
+    def poll(imageids):
+        res = session.get(baseurl + '/retrieve',
+                          params={"image_ids": ",".join(str(i) for i in imageids), "wait": 20})
+        body = res.json()
+        if res.status_code != 200:
+            raise Exception(body)
+        return body["results"]
+
+    deadline = time.monotonic() + max_wait
+    while waiting and time.monotonic() < deadline:
+        imageids = list(waiting)
+        chunks = [imageids[i:i + RETRIEVE_CHUNK] for i in range(0, len(imageids), RETRIEVE_CHUNK)]
+
+        failed = 0
+        for future in concurrent.futures.as_completed([pool.submit(poll, chunk) for chunk in chunks]):
+            try:
+                results = future.result()
+            except Exception as e:
+                # retried in the next round
+                logging.error("batch retrieve failed: " + str(e))
+                failed += 1
+                continue
+
+            for result in results:
+                # ids the service doesn't know come back as sent
+                imageid = int(result["image_id"])
+                rows = waiting.get(imageid)
+                if rows is None:
+                    continue
+                if not result.get("found"):
+                    update = {"status": "error", "error": result.get("error")}
+                elif result.get("status") in ("pending", "in_progress"):
+                    for row in rows:
+                        row["status"] = result["status"]
+                    continue
+                else:
+                    update = {"status": result.get("status") or "error",
+                              "precentage_ai": result.get("precentage_ai"),
+                              "model_version": result.get("model_version"),
+                              "error": result.get("error")}
+                    if cache is not None:
+                        cache.update_result(imageid, result)
+                for row in rows:
+                    row.update(update)
+                    writer.write(row)
+                del waiting[imageid]
+
+        print("finished:", len(writer.rows), "still waiting:",
+              sum(len(rows) for rows in waiting.values()), file=sys.stderr)
+        if failed == len(chunks):
+            time.sleep(5)
+
+    for rows in waiting.values():
+        for row in rows:
+            writer.write(row)
+
+
+def upload_chunk(baseurl, session, pool, filenames, model_input_only, cache):
+    """
+    Uploads a chunk of files: those not in cache are registered with
+    one batch upload call, then their bytes are posted to the
+    presigned uploads concurrently.
+
+    Returns
+    -------
+    a list of (filename, result) in order, result being what
+    upload_file returns, or the Exception the file failed with
+    """
+
+    def prepare(filename):
+        try:
+            prepared = read_upload(filename, model_input_only)
+            return prepared, cache.get(prepared["digest"]) if cache is not None else None
+        except Exception as e:
+            return e, None
+
+    prepared_files = list(pool.map(prepare, filenames))
+
+    # stale cache entries are checked again with one call per chunk
+    entries = [entry for _, entry in prepared_files]
+    if cache is not None:
+        entries = recheck_many(baseurl, cache, entries, session)
+
+    outcomes = {}
+    new = []
+    for filename, (prepared, _), entry in zip(filenames, prepared_files, entries):
+        if isinstance(prepared, Exception):
+            outcomes[filename] = prepared
+        elif entry is not None:
+            outcomes[filename] = cached_answer(prepared, entry)
+        else:
+            new.append((filename, prepared))
+
+    if new:
+        started = time.perf_counter()
+        try:
+            res = session.post(baseurl + '/upload',
+                               json={"files": [upload_entry(prepared) for _, prepared in new]})
+            body = res.json()
+            if res.status_code != 200:
+                raise Exception(body)
+            entries = body["files"]
+        except Exception as e:
+            entries = [e] * len(new)
+
+        def store(item):
+            (filename, prepared), entry = item
+            try:
+                if isinstance(entry, Exception):
+                    raise entry
+                if "error" in entry:
+                    raise Exception(entry["error"])
+                if not entry.get("duplicate"):
+                    store_upload(entry["upload"], prepared, session)
+                return finish_upload(entry, prepared, started, cache)
+            except Exception as e:
+                return e
+
+        for (filename, _), outcome in zip(new, pool.map(store, zip(new, entries))):
+            outcomes[filename] = outcome
+
+    return [(filename, outcomes[filename]) for filename in filenames]
+
+
+def batch(baseurl, argv):
+    """
+    Non-interactive mode: uploads every image in a directory or
+    matching a glob concurrently, waits for all the predictions and
+    writes them as CSV (or JSON) without prompting or plotting, e.g.
+
+        python client.py batch ./images --out results.csv --workers 16
+
+    Parameters
+    ----------
+    baseurl: baseurl for web service
+    argv: command line arguments after the program name
+
+    Returns
+    -------
+    nothing
+    """
+
+    parser = argparse.ArgumentParser(prog="client.py batch",
+                                     description="Score a folder of images")
+    parser.add_argument("files", help="a directory or a glob pattern, e.g. 'shots/**/*.jpg'")
+    parser.add_argument("--out", help="results file, .csv or .json (default: CSV on stdout)")
+    parser.add_argument("--workers", type=int, default=16, help="concurrent uploads")
+    parser.add_argument("--model-input-only", action="store_true",
+                        help="upload only the 32x32 image the model sees")
+    parser.add_argument("--max-wait", type=float, default=900,
+                        help="seconds to wait for predictions once uploads are done")
+    parser.add_argument("--cache", default=CACHE_PATH,
+                        help="local result cache; files seen before aren't uploaded again")
+    parser.add_argument("--no-cache", action="store_true", help="don't use the local result cache")
+    parser.add_argument("--cache-size", type=int, default=CACHE_MAX_BYTES // (1024 * 1024),
+                        help="local result cache limit in MB")
+    args = parser.parse_args(argv)
+
+    files = find_files(args.files)
+    if not files:
+        print("no .jpg, .jpeg or .png files found for", args.files, file=sys.stderr)
+        return
+
+    cache = None if args.no_cache else LocalCache(args.cache, args.cache_size * 1024 * 1024)
+    session = make_session(baseurl, args.workers)
+    writer = ResultWriter(args.out)
+    waiting = {}
+    started = time.perf_counter()
+    sent = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for start in range(0, len(files), UPLOAD_CHUNK):
+            chunk = files[start:start + UPLOAD_CHUNK]
+
+            for filename, result in upload_chunk(baseurl, session, pool, chunk,
+                                                 args.model_input_only, cache):
+                row = {"file": filename}
+                if isinstance(result, Exception):
+                    row.update(status="error", error="upload failed: " + str(result))
+                    writer.write(row)
+                    continue
+
+                sent += result["sent_bytes"]
+                row.update(image_id=result["imageID"], sent_bytes=result["sent_bytes"],
+                           duplicate=bool(result.get("duplicate")), cached=bool(result.get("cached")))
+                if result.get("duplicate") or result.get("status") in FINAL_STATUSES:
+                    # analyzed before, the result came with the upload
+                    # or from the local cache
+                    row.update(status=result["status"], precentage_ai=result["precentage_ai"],
+                               model_version=result["model_version"])
+                    writer.write(row)
+                else:
+                    row["status"] = "pending"
+                    # identical files in one batch share a job
+                    waiting.setdefault(result["imageID"], []).append(row)
+
+            print("uploaded:", start + len(chunk), "of", len(files), file=sys.stderr)
+
+        collect_results(baseurl, session, pool, waiting, writer, args.max_wait, cache)
+
+    writer.close()
+
+    elapsed = time.perf_counter() - started
+    statuses = {}
+    for row in writer.rows:
+        statuses[row["status"]] = statuses.get(row["status"], 0) + 1
+    print("files:", len(files), statuses, "bytes sent:", sent,
+          "in %.1f s (%.1f files/s)" % (elapsed, len(files) / elapsed), file=sys.stderr)
+    if cache is not None:
+        print("local cache hits:", cache.hits, "misses:", cache.misses, file=sys.stderr)
+        cache.close()
+
+
 ############################################################
 # main
 #
 try:
+    baseurl = f"https://rce057rit7.execute-api.us-east-2.amazonaws.com/prod"
+
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        batch(baseurl, sys.argv[2:])
+        sys.exit(0)
+
     print()
     print('**                       ArtIfact: Detecting AI-generated Art                        **')
     print('**                       Blake Hu, Adela Jianu, Shirley Zhang                        **')
@@ -255,21 +1175,26 @@ try:
     print('** This app will tell you the percentage likelihood of your image being AI generated **')
     print('**                                                                                   **')
     print('**                First upload your image, then retrieve your results                **')
-    print('**            It may take a few seconds, if your status is pending, retry            **')
-    print('**                     This app only takes .jpg or .jpeg files                       **')
-    print('**          .png files are not supported due to the additional alpha channel         **')
+    print('**     It may take a few seconds, use upload and wait to get the result at once      **')
+    print('**                     This app takes .jpg, .jpeg and .png files                     **')
+    print('**         .png transparency is dropped, the image is scored on its colours          **')
     print()
 
-    baseurl = f"https://rce057rit7.execute-api.us-east-2.amazonaws.com/prod"
+    # finished results are remembered between runs
+    cache = LocalCache()
 
     # prompt the user to upload or retrieve
     cmd = prompt()
 
     while cmd != 0:
         if cmd == 1:
-            upload(baseurl)
+            upload(baseurl, cache)
         elif cmd == 2:
-            retrieve(baseurl)
+            retrieve(baseurl, cache)
+        elif cmd == 3:
+            upload_and_wait(baseurl, cache=cache)
+        elif cmd == 4:
+            compare_upload_modes(baseurl)
         else:
             print("** Unknown command, try again...")
         cmd = prompt()